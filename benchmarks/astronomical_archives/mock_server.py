@@ -0,0 +1,491 @@
+"""
+Local stand-in for the IVOA services used by astronomical_archives.py:
+TAP sync and async (UWS) endpoints with VOSI tables and an obscore
+table, a RegTAP registry listing the mock archives, and FITS-like files
+with ETag and Range support. Latency, payload size and failure rate are
+configurable so that benchmarks never depend on live services.
+"""
+
+import argparse
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+VOTABLE_HEADER = \
+    '<?xml version="1.0" encoding="utf-8"?>' \
+    '<VOTABLE version="1.3" xmlns="http://www.ivoa.net/xml/VOTable/v1.3">' \
+    '<RESOURCE type="results">' \
+    '<INFO name="QUERY_STATUS" value="OK"/><TABLE>'
+
+VOTABLE_FOOTER = '</TABLEDATA></DATA></TABLE></RESOURCE></VOTABLE>'
+
+VOTABLE_ERROR = \
+    '<?xml version="1.0" encoding="utf-8"?>' \
+    '<VOTABLE version="1.3" xmlns="http://www.ivoa.net/xml/VOTable/v1.3">' \
+    '<RESOURCE type="results">' \
+    '<INFO name="QUERY_STATUS" value="ERROR">{}</INFO>' \
+    '</RESOURCE></VOTABLE>'
+
+OBSCORE_FIELDS = [
+    ('obs_publisher_id', 'char'),
+    ('obs_collection', 'char'),
+    ('obs_id', 'char'),
+    ('target_name', 'char'),
+    ('dataproduct_type', 'char'),
+    ('access_url', 'char'),
+    ('access_format', 'char'),
+    ('access_estsize', 'long'),
+    ('s_ra', 'double'),
+    ('s_dec', 'double'),
+    ('t_min', 'double'),
+    ('calib_level', 'int'),
+]
+
+REGTAP_FIELDS = [
+    'ivoid', 'res_type', 'short_name', 'res_title', 'content_level',
+    'res_description', 'reference_url', 'creator_seq', 'content_type',
+    'source_format', 'source_value', 'region_of_regard', 'waveband',
+    'access_urls', 'standard_ids', 'intf_types', 'intf_roles'
+]
+
+TOKEN_SEP = ':::py VO sep:::'
+
+
+class MockConfiguration:
+
+    def __init__(self,
+                 latency=0.0,
+                 rows=100,
+                 extra_columns=20,
+                 file_size=1024 ** 2,
+                 failure_rate=0.0,
+                 archives=3,
+                 async_polls=2,
+                 seed=0,
+                 async_jobs=True):
+
+        self.latency = latency
+        self.rows = rows
+        self.extra_columns = extra_columns
+        self.file_size = file_size
+        self.failure_rate = failure_rate
+        self.archives = archives
+        self.async_polls = async_polls
+        self.async_jobs = async_jobs
+        self.random = random.Random(seed)
+
+    def get_fields(self):
+        return OBSCORE_FIELDS + \
+            [('extra_' + str(i), 'double') for i in range(self.extra_columns)]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def configuration(self):
+        return self.server.configuration
+
+    @property
+    def base_url(self):
+        return 'http://%s:%s' % self.server.server_address[:2]
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def do_DELETE(self):
+        self._handle()
+
+    def _handle(self):
+        self._read_body()
+
+        if self.configuration.latency:
+            time.sleep(self.configuration.latency)
+
+        if self.configuration.failure_rate and \
+                self.configuration.random.random() < \
+                self.configuration.failure_rate:
+            return self._send(503, 'text/plain', b'service unavailable')
+
+        path = urllib.parse.urlparse(self.path).path
+
+        if path.startswith('/files/'):
+            return self._send_file()
+
+        if path.startswith('/registry/'):
+            return self._send_registry()
+
+        match = re.match(r'/archive(\d+)/tap(/.*)?$', path)
+
+        if match is None:
+            return self._send(404, 'text/plain', b'not found')
+
+        archive, endpoint = int(match.group(1)), match.group(2) or ''
+
+        if endpoint == '/tables':
+            return self._send_tables()
+        elif endpoint == '/tables/ivoa.obscore':
+            return self._send_tables(single_table=True)
+        elif endpoint == '/sync':
+            return self._send_query(archive, self._get_parameter('QUERY'))
+        elif endpoint.startswith('/async'):
+            return self._handle_job(archive, endpoint)
+
+        return self._send(404, 'text/plain', b'not found')
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode() if length else ''
+
+        self.parameters = urllib.parse.parse_qs(
+            urllib.parse.urlparse(self.path).query)
+        self.parameters.update(urllib.parse.parse_qs(body))
+
+        self.parameters = {key.upper(): value
+                           for key, value in self.parameters.items()}
+
+    def _get_parameter(self, name, default=''):
+        return self.parameters.get(name, [default])[0]
+
+    def _send(self, status, content_type, body, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+
+        self.end_headers()
+
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _redirect(self, location):
+        self._send(303, 'text/plain', b'', {'Location': location})
+
+    def _send_query(self, archive, query):
+        if 'TAP_SCHEMA.tables' in query:
+            table_name = re.search(r"table_name\s*=\s*'([^']*)'", query)
+
+            return self._send_votable(
+                [('table_name', 'char'), ('table_type', 'char')],
+                [[name, 'table'] for name in
+                 ['ivoa.obscore', 'TAP_SCHEMA.tables']
+                 if table_name is None or table_name.group(1) == name])
+
+        if 'TAP_SCHEMA.columns' in query:
+            return self._send_votable(
+                [('column_name', 'char'), ('description', 'char'),
+                 ('unit', 'char'), ('datatype', 'char')],
+                [[name, name, '', datatype] for name, datatype in
+                 self.configuration.get_fields()])
+
+        if 'obscore' not in query:
+            return self._send(400, 'text/xml', VOTABLE_ERROR.format(
+                'unknown table').encode())
+
+        top = re.search(r'TOP\s+(\d+)', query, re.IGNORECASE)
+        maxrec = self._get_parameter('MAXREC')
+
+        number_of_rows = self.configuration.rows
+
+        if top:
+            number_of_rows = min(number_of_rows, int(top.group(1)))
+        if maxrec:
+            number_of_rows = min(number_of_rows, int(maxrec))
+
+        fields = self.configuration.get_fields()
+
+        rows = (self._get_obscore_row(archive, i, fields)
+                for i in range(number_of_rows))
+
+        self._send_votable(fields, rows)
+
+    def _get_obscore_row(self, archive, index, fields):
+        # even indexes are shared by every archive, like mirrored services
+        owner = 0 if index % 2 == 0 else archive
+
+        values = {
+            'obs_publisher_id': 'ivo://mock/%d?%d' % (owner, index),
+            'obs_collection': 'collection_%d' % (index % 7),
+            'obs_id': 'obs_%d' % index,
+            'target_name': 'target_%d' % (index % 13),
+            'dataproduct_type': 'image',
+            'access_url': '%s/files/%d_%d.fits' % (self.base_url,
+                                                   owner,
+                                                   index),
+            'access_format': 'application/fits',
+            'access_estsize': (index * 7919) % 100000,
+            's_ra': index * 0.01,
+            's_dec': -index * 0.01,
+            't_min': 59000 + index,
+            'calib_level': index % 4,
+        }
+
+        return [values.get(name, index * 0.5) for name, _ in fields]
+
+    def _send_votable(self, fields, rows):
+        chunks = [VOTABLE_HEADER]
+
+        for name, datatype in fields:
+            arraysize = ' arraysize="*"' if datatype == 'char' else ''
+            chunks.append('<FIELD name="%s" datatype="%s"%s/>'
+                          % (name, datatype, arraysize))
+
+        chunks.append('<DATA><TABLEDATA>')
+
+        for row in rows:
+            chunks.append('<TR>' + ''.join(
+                '<TD>%s</TD>' % escape(str(value)) for value in row) +
+                '</TR>')
+
+        chunks.append(VOTABLE_FOOTER)
+
+        self._send(200, 'text/xml', ''.join(chunks).encode())
+
+    def _send_tables(self, single_table=False):
+        columns = ''.join(
+            '<column><name>%s</name><dataType xsi:type="vs:VOTableType">'
+            '%s</dataType></column>' % (name, datatype)
+            for name, datatype in self.configuration.get_fields())
+
+        namespaces = \
+            'xmlns:vosi="http://www.ivoa.net/xml/VOSITables/v1.0" ' \
+            'xmlns:vs="http://www.ivoa.net/xml/VODataService/v1.1" ' \
+            'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"'
+
+        if single_table:
+            body = \
+                '<?xml version="1.0" encoding="utf-8"?>' \
+                '<vosi:table type="output" ' + namespaces + '>' \
+                '<name>ivoa.obscore</name>' + columns + '</vosi:table>'
+        else:
+            body = \
+                '<?xml version="1.0" encoding="utf-8"?>' \
+                '<vosi:tableset ' + namespaces + '>' \
+                '<schema><name>ivoa</name><table type="output">' \
+                '<name>ivoa.obscore</name>' + columns + \
+                '</table></schema></vosi:tableset>'
+
+        self._send(200, 'text/xml', body.encode())
+
+    def _handle_job(self, archive, endpoint):
+        jobs = self.server.jobs
+        parts = endpoint.strip('/').split('/')
+        tap_url = '%s/archive%d/tap' % (self.base_url, archive)
+
+        if len(parts) == 1:
+            # services without UWS support
+            if not self.configuration.async_jobs:
+                return self._send(404, 'text/plain', b'not found')
+
+            # job list, where deleted jobs redirect to
+            if self.command != 'POST':
+                return self._send(
+                    200, 'text/xml',
+                    b'<?xml version="1.0" encoding="utf-8"?>'
+                    b'<uws:jobs xmlns:uws="http://www.ivoa.net/xml/UWS/v1.0"'
+                    b'/>')
+
+            with self.server.lock:
+                self.server.job_count += 1
+                job_id = str(self.server.job_count)
+                jobs[job_id] = {'query': self._get_parameter('QUERY'),
+                                'polls': 0,
+                                'phase': 'PENDING'}
+
+            return self._redirect(tap_url + '/async/' + job_id)
+
+        job = jobs.get(parts[1])
+
+        if job is None:
+            return self._send(404, 'text/plain', b'no such job')
+
+        if self.command == 'DELETE' or \
+                self._get_parameter('ACTION') == 'DELETE':
+            jobs.pop(parts[1], None)
+            return self._redirect(tap_url + '/async')
+
+        if parts[2:] == ['phase'] and self.command == 'POST':
+            job['phase'] = 'EXECUTING'
+            return self._redirect(tap_url + '/async/' + parts[1])
+
+        if parts[2:] == ['results', 'result']:
+            return self._send_query(archive, job['query'])
+
+        if job['phase'] == 'EXECUTING':
+            job['polls'] += 1
+
+            if job['polls'] > self.configuration.async_polls:
+                job['phase'] = 'COMPLETED'
+
+        results = ''
+
+        if job['phase'] == 'COMPLETED':
+            results = '<uws:result id="result" xlink:href="%s"/>' % \
+                (tap_url + '/async/' + parts[1] + '/results/result')
+
+        body = \
+            '<?xml version="1.0" encoding="utf-8"?>' \
+            '<uws:job xmlns:uws="http://www.ivoa.net/xml/UWS/v1.0" ' \
+            'xmlns:xlink="http://www.w3.org/1999/xlink">' \
+            '<uws:jobId>%s</uws:jobId><uws:phase>%s</uws:phase>' \
+            '<uws:executionDuration>0</uws:executionDuration>' \
+            '<uws:parameters/><uws:results>%s</uws:results></uws:job>' \
+            % (parts[1], job['phase'], results)
+
+        self._send(200, 'text/xml', body.encode())
+
+    def _send_registry(self):
+        rows = []
+
+        for archive in range(self.configuration.archives):
+            values = {
+                'ivoid': 'ivo://mock/archive%d' % archive,
+                'res_type': 'vs:catalogservice',
+                'short_name': 'mock%d' % archive,
+                'res_title': 'Mock archive %d' % archive,
+                'res_description': 'Mock obscore archive',
+                'waveband': 'optical',
+                'access_urls': '%s/archive%d/tap' % (self.base_url, archive),
+                'standard_ids': 'ivo://ivoa.net/std/tap',
+                'intf_types': 'tr:tap',
+                'intf_roles': 'std',
+            }
+
+            rows.append([values.get(name, '') for name in REGTAP_FIELDS])
+
+        self._send_votable([(name, 'char') for name in REGTAP_FIELDS], rows)
+
+    def _send_file(self):
+        size = self.configuration.file_size
+        etag = '"%d"' % size
+
+        if self.headers.get('If-None-Match') == etag:
+            return self._send(304, 'application/fits', b'')
+
+        start = 0
+        status = 200
+        headers = {'ETag': etag}
+
+        range_header = self.headers.get('Range')
+
+        if range_header and self.headers.get('If-Range', etag) == etag:
+            start = int(range_header.split('=')[1].split('-')[0])
+
+            if start >= size:
+                return self._send(416, 'text/plain', b'', {
+                    'Content-Range': 'bytes */%d' % size})
+
+            status = 206
+            headers['Content-Range'] = \
+                'bytes %d-%d/%d' % (start, size - 1, size)
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/fits')
+        self.send_header('Content-Length', str(size - start))
+
+        for key, value in headers.items():
+            self.send_header(key, value)
+
+        self.end_headers()
+
+        block = b'SIMPLE  =' + b' ' * (64 * 1024 - 9)
+        remaining = size - start
+
+        while remaining > 0:
+            chunk = block[:remaining]
+            self.wfile.write(chunk)
+            remaining -= len(chunk)
+
+
+class MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients dropping keep-alive connections are not errors here
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class MockServer:
+    """
+    Mock services running in a background thread, usable as a context
+    manager
+    """
+
+    def __init__(self, configuration=None, host='127.0.0.1', port=0):
+        self.configuration = configuration or MockConfiguration()
+        self.server = MockHTTPServer((host, port), MockHandler)
+        self.server.configuration = self.configuration
+        self.server.jobs = {}
+        self.server.job_count = 0
+        self.server.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.server.server_address[:2]
+
+    @property
+    def registry_url(self):
+        return self.url + '/registry'
+
+    def get_archive_url(self, archive=0):
+        return '%s/archive%d/tap' % (self.url, archive)
+
+    def get_file_url(self, name):
+        return '%s/files/%s.fits' % (self.url, name)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the mock services')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--rows', type=int, default=100)
+    parser.add_argument('--extra-columns', type=int, default=20)
+    parser.add_argument('--file-size', type=int, default=1024 ** 2)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--archives', type=int, default=3)
+
+    arguments = parser.parse_args()
+
+    mock_server = MockServer(MockConfiguration(arguments.latency,
+                                               arguments.rows,
+                                               arguments.extra_columns,
+                                               arguments.file_size,
+                                               arguments.failure_rate,
+                                               arguments.archives),
+                             port=arguments.port)
+
+    print('Mock services on ' + mock_server.url)
+    print('Registry (IVOA_REGISTRY) : ' + mock_server.registry_url)
+
+    mock_server.server.serve_forever()
@@ -0,0 +1,417 @@
+"""
+Benchmarks of astronomical_archives.py against the local mock services
+of mock_server.py, so that results only depend on the code and the
+machine. Results are written as JSON and can be compared with an
+earlier run:
+
+    python run_benchmarks.py --label before
+    python run_benchmarks.py --label after --compare results/before.json
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+
+from mock_server import MockConfiguration, MockServer
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+TOOL_DIRECTORY = os.path.join(BENCHMARK_DIRECTORY, '..', '..', 'tools',
+                              'archives', 'pyvo_integration')
+RESULTS_DIRECTORY = os.path.join(BENCHMARK_DIRECTORY, 'results')
+
+REGRESSION_THRESHOLD = 0.2
+IMPORT_TIME_BUDGET = 0.5
+DEFERRED_MODULES = ['astropy', 'pyvo']
+
+
+class BenchmarkSuite:
+
+    def __init__(self, configuration, repeat, number_of_files):
+        self.repeat = repeat
+        self.number_of_files = number_of_files
+        self.results = {}
+        self.eager_modules = []
+
+        self.cache_directory = tempfile.mkdtemp(prefix='aa_cache_')
+        self.work_directory = tempfile.mkdtemp(prefix='aa_work_')
+
+        self.mock_server = MockServer(configuration).start()
+
+        # both are read when the modules are imported
+        os.environ['ASTRONOMICAL_ARCHIVES_CACHE'] = self.cache_directory
+        os.environ['IVOA_REGISTRY'] = self.mock_server.registry_url
+
+        sys.path.insert(0, os.path.abspath(TOOL_DIRECTORY))
+
+        import astronomical_archives
+        self.archives = astronomical_archives
+
+    def close(self):
+        self.mock_server.stop()
+
+        shutil.rmtree(self.cache_directory, ignore_errors=True)
+        shutil.rmtree(self.work_directory, ignore_errors=True)
+
+    def get_benchmarks(self):
+        return {
+            'import_time': self.bench_import_time,
+            'collect_resource_keys': self.bench_collect_resource_keys,
+            'html_report': self.bench_html_report,
+            'votable_hydration': self.bench_votable_hydration,
+            'downloads': self.bench_downloads,
+            'tool_runner_archive': self.bench_tool_runner_archive,
+            'tool_runner_registry': self.bench_tool_runner_registry,
+            'tool_runner_async': self.bench_tool_runner_async,
+        }
+
+    def run(self, names=None):
+        for name, benchmark in self.get_benchmarks().items():
+            if names and name not in names:
+                continue
+
+            times = benchmark()
+
+            self.results[name] = {
+                'median': statistics.median(times),
+                'min': min(times),
+                'max': max(times),
+                'times': times
+            }
+
+            print('%-24s median %9.4fs  min %9.4fs  max %9.4fs'
+                  % (name, self.results[name]['median'],
+                     self.results[name]['min'],
+                     self.results[name]['max']))
+
+        return self.results
+
+    def measure(self, function, setup=None):
+        times = []
+
+        for _ in range(self.repeat):
+            argument = setup() if setup is not None else None
+
+            start = time.perf_counter()
+
+            if setup is not None:
+                function(argument)
+            else:
+                function()
+
+            times.append(time.perf_counter() - start)
+
+        return times
+
+    def bench_import_time(self):
+        command = [
+            sys.executable, '-c',
+            'import sys, time; start = time.perf_counter(); '
+            'import astronomical_archives; '
+            'print(*[name for name in sys.modules '
+            'if name.split(".")[0] in %r]); '
+            'print(time.perf_counter() - start)' % DEFERRED_MODULES
+        ]
+
+        times = []
+
+        for _ in range(self.repeat):
+            output = subprocess.run(command,
+                                    cwd=TOOL_DIRECTORY,
+                                    env=os.environ.copy(),
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL,
+                                    check=True)
+
+            lines = output.stdout.decode().splitlines()
+
+            self.eager_modules = lines[0].split()
+            times.append(float(lines[-1]))
+
+        return times
+
+    def get_resources(self, number_of_rows=20000, number_of_keys=40):
+        resources = []
+
+        for i in range(number_of_rows):
+            resource = {'key_' + str(k): i * k
+                        for k in range(number_of_keys)}
+
+            # archives do not all return the same columns
+            if i % 3 == 0:
+                resource['extra_' + str(i % 5)] = i
+
+            resources.append(resource)
+
+        return resources
+
+    def bench_collect_resource_keys(self):
+        resources = self.get_resources()
+
+        return self.measure(
+            lambda: self.archives.Utils.collect_resource_keys(resources))
+
+    def bench_html_report(self):
+        resource_table = self.archives.ResourceTable.from_resources(
+            self.get_resources())
+
+        return self.measure(
+            lambda: self.archives.OutputHandler.write_html_content(
+                io.StringIO(),
+                resource_table,
+                'mock archive',
+                'SELECT * FROM ivoa.obscore'))
+
+    def bench_votable_hydration(self):
+        number_of_rows = self.mock_server.configuration.rows
+
+        query = urllib.parse.urlencode({
+            'REQUEST': 'doQuery',
+            'LANG': 'ADQL',
+            'QUERY': 'SELECT TOP %d * FROM ivoa.obscore' % number_of_rows
+        })
+
+        with urllib.request.urlopen(self.mock_server.get_archive_url() +
+                                    '/sync?' + query) as response:
+            payload = response.read()
+
+        return self.measure(
+            lambda votable: votable.read_table(number_of_rows),
+            lambda: self.archives.VOTableStream(io.BytesIO(payload),
+                                                'mock'))
+
+    def bench_downloads(self):
+        download_directory = os.path.join(self.work_directory, 'downloads')
+
+        def setup():
+            shutil.rmtree(download_directory, ignore_errors=True)
+            os.makedirs(download_directory)
+
+            return [(self.mock_server.get_file_url('file_' + str(i)),
+                     os.path.join(download_directory, str(i) + '.fits'))
+                    for i in range(self.number_of_files)]
+
+        def download(downloads):
+            downloader = self.archives.Downloader()
+
+            for url, path, exception in downloader.download(downloads):
+                pass
+
+        return self.measure(download, setup)
+
+    def get_inputs(self, archive_selection, query_mode='sync'):
+        return {
+            'archive_selection': archive_selection,
+            'query_section': {
+                'query_mode': query_mode,
+                'query_selection': {
+                    'query_type': 'obscore_query',
+                    'dataproduct_type': 'image',
+                    'obs_collection': '',
+                    'obs_title': '',
+                    'obs_id': '',
+                    'facility_name': '',
+                    'instrument_name': '',
+                    'em_min': None,
+                    'em_max': None,
+                    'target_name': '',
+                    'obs_publisher_id': '',
+                    's_fov': '',
+                    'calibration_level': 'none',
+                    't_min': None,
+                    't_max': None,
+                    'order_by': 'size',
+                    'cone_section': {
+                        'cone_search_target_selection': {
+                            'target_selection': 'coordinates',
+                            'ra': '',
+                            'dec': ''
+                        },
+                        'radius': ''
+                    }
+                }
+            },
+            'output_section': {
+                'number_of_files': str(self.number_of_files),
+                'output_selection': ['c', 'i', 'h', 'b']
+            }
+        }
+
+    def run_tool(self, inputs):
+        inputs_path = os.path.join(self.work_directory, 'inputs.json')
+
+        with open(inputs_path, 'w') as inputs_file:
+            json.dump(inputs, inputs_file)
+
+        def setup():
+            # every run starts cold, without caches or earlier logs
+            shutil.rmtree(self.cache_directory, ignore_errors=True)
+            os.makedirs(self.cache_directory)
+
+            shutil.rmtree(os.path.join(self.work_directory, 'fits'),
+                          ignore_errors=True)
+            os.makedirs(os.path.join(self.work_directory, 'fits'))
+
+            self.archives.Logger.reset()
+
+        def run_tool(_):
+            current_directory = os.getcwd()
+            os.chdir(self.work_directory)
+
+            try:
+                self.archives.ToolRunner(inputs_path,
+                                         'output.fits',
+                                         'output.csv',
+                                         'output.html',
+                                         'output_basic.html',
+                                         'output_error.txt').run()
+            finally:
+                os.chdir(current_directory)
+
+        return self.measure(run_tool, setup)
+
+    def bench_tool_runner_archive(self):
+        return self.run_tool(self.get_inputs({
+            'archive_type': 'archive',
+            'archive': self.mock_server.get_archive_url()
+        }))
+
+    def bench_tool_runner_registry(self):
+        return self.run_tool(self.get_inputs({
+            'archive_type': 'registry',
+            'keyword': 'mock',
+            'service_type': 'TAP',
+            'wavebands': 'all'
+        }))
+
+    def bench_tool_runner_async(self):
+        return self.run_tool(self.get_inputs({
+            'archive_type': 'archive',
+            'archive': self.mock_server.get_archive_url()
+        }, query_mode='async'))
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    regressions = []
+
+    print('\n%-24s %10s %10s %8s' % ('benchmark', 'baseline', 'current',
+                                     'ratio'))
+
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        ratio = result['median'] / baseline[name]['median']
+
+        flag = ''
+
+        if ratio > 1 + threshold:
+            flag = '  regression'
+            regressions.append(name)
+
+        print('%-24s %9.4fs %9.4fs %7.2fx%s'
+              % (name, baseline[name]['median'], result['median'], ratio,
+                 flag))
+
+    return regressions
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--label', default='current',
+                        help='name of the results file')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', action='append', default=[],
+                        help='benchmark to run, can be repeated')
+    parser.add_argument('--compare', help='results file to compare with')
+    parser.add_argument('--threshold', type=float,
+                        default=REGRESSION_THRESHOLD,
+                        help='slowdown ratio reported as a regression')
+    parser.add_argument('--fail-on-regression', action='store_true')
+    parser.add_argument('--import-budget', type=float,
+                        default=IMPORT_TIME_BUDGET,
+                        help='maximum import time in seconds')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='mock service latency in seconds')
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--extra-columns', type=int, default=20)
+    parser.add_argument('--file-size', type=int, default=1024 ** 2)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--archives', type=int, default=3)
+    parser.add_argument('--number-of-files', type=int, default=8)
+
+    arguments = parser.parse_args(arguments)
+
+    configuration = MockConfiguration(arguments.latency,
+                                      arguments.rows,
+                                      arguments.extra_columns,
+                                      arguments.file_size,
+                                      arguments.failure_rate,
+                                      arguments.archives)
+
+    suite = BenchmarkSuite(configuration,
+                           arguments.repeat,
+                           arguments.number_of_files)
+
+    try:
+        results = suite.run(arguments.only)
+    finally:
+        suite.close()
+
+    report = {
+        'label': arguments.label,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'configuration': {
+            key: value for key, value in vars(arguments).items()
+            if key not in ['label', 'only', 'compare', 'fail_on_regression']
+        },
+        'benchmarks': results
+    }
+
+    os.makedirs(RESULTS_DIRECTORY, exist_ok=True)
+
+    results_path = os.path.join(RESULTS_DIRECTORY, arguments.label + '.json')
+
+    with open(results_path, 'w') as results_file:
+        json.dump(report, results_file, indent=1)
+
+    print('\nResults written to ' + results_path)
+
+    failed = False
+
+    if arguments.compare:
+        with open(arguments.compare, 'r') as baseline_file:
+            baseline = json.load(baseline_file)['benchmarks']
+
+        regressions = compare(results, baseline, arguments.threshold)
+
+        failed = bool(regressions) and arguments.fail_on_regression
+
+    if 'import_time' in results:
+        if results['import_time']['median'] > arguments.import_budget:
+            print('Import time over budget (%.3fs > %.3fs)'
+                  % (results['import_time']['median'],
+                     arguments.import_budget))
+            failed = True
+
+        if suite.eager_modules:
+            print('Modules imported at start up: ' +
+                  ', '.join(suite.eager_modules[:10]))
+            failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,18 @@
+import os
+import sys
+import tempfile
+
+TOOL_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              '..', '..', 'tools', 'archives',
+                              'pyvo_integration')
+TEST_DATA_DIRECTORY = os.path.join(TOOL_DIRECTORY, 'test-data')
+BENCHMARK_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   '..', '..', 'benchmarks',
+                                   'astronomical_archives')
+
+# read when the module is imported, the tests never use the user cache
+os.environ['ASTRONOMICAL_ARCHIVES_CACHE'] = \
+    tempfile.mkdtemp(prefix='aa_test_cache_')
+
+sys.path.insert(0, os.path.abspath(TOOL_DIRECTORY))
+sys.path.insert(0, os.path.abspath(BENCHMARK_DIRECTORY))
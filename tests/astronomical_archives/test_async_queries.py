@@ -0,0 +1,133 @@
+import json
+import time
+
+from astronomical_archives import Logger, Registry, TapArchive, ToolRunner
+
+from mock_server import MockConfiguration, MockServer
+
+import pytest
+
+NUMBER_OF_ARCHIVES = 3
+ROWS_PER_ARCHIVE = 10
+
+
+@pytest.fixture
+def mock_server(request):
+    configuration = MockConfiguration(rows=ROWS_PER_ARCHIVE,
+                                      extra_columns=2,
+                                      archives=NUMBER_OF_ARCHIVES,
+                                      async_polls=1,
+                                      **getattr(request, 'param', {}))
+
+    with MockServer(configuration) as mock_server:
+        yield mock_server
+
+
+def get_inputs(archive_selection, number_of_files):
+    return {
+        'archive_selection': archive_selection,
+        'query_section': {
+            'query_mode': 'async',
+            'query_selection': {
+                'query_type': 'obscore_query',
+                'dataproduct_type': 'image',
+                'obs_collection': '',
+                'obs_title': '',
+                'obs_id': '',
+                'facility_name': '',
+                'instrument_name': '',
+                'em_min': None,
+                'em_max': None,
+                'target_name': '',
+                'obs_publisher_id': '',
+                's_fov': '',
+                'calibration_level': 'none',
+                't_min': None,
+                't_max': None,
+                'order_by': 'none',
+                'cone_section': {
+                    'cone_search_target_selection': {
+                        'target_selection': 'coordinates',
+                        'ra': '',
+                        'dec': ''
+                    },
+                    'radius': ''
+                }
+            }
+        },
+        'output_section': {
+            'number_of_files': str(number_of_files),
+            'output_selection': ['c']
+        }
+    }
+
+
+def run_tool(tmp_path, inputs):
+    inputs_path = tmp_path / 'inputs.json'
+    inputs_path.write_text(json.dumps(inputs))
+
+    Logger.reset()
+
+    ToolRunner(str(inputs_path),
+               str(tmp_path / 'output.fits'),
+               str(tmp_path / 'output.csv'),
+               str(tmp_path / 'output.html'),
+               str(tmp_path / 'output_basic.html'),
+               str(tmp_path / 'output_error.txt')).run()
+
+    return [url for url in (tmp_path / 'output.csv').read_text().split(',')
+            if url]
+
+
+def wait_for_jobs(mock_server, timeout=5):
+    # jobs of tasks still running when the results were closed are
+    # deleted once they end
+    end = time.monotonic() + timeout
+
+    while mock_server.server.jobs and time.monotonic() < end:
+        time.sleep(0.05)
+
+    return mock_server.server.jobs
+
+
+def test_async_query_returns_the_job_results(tmp_path, mock_server):
+    urls = run_tool(tmp_path, get_inputs(
+        {'archive_type': 'archive', 'archive': mock_server.get_archive_url()},
+        3))
+
+    assert urls == [mock_server.get_file_url('0_' + str(i))
+                    for i in range(3)]
+    assert mock_server.server.job_count == 1
+    assert wait_for_jobs(mock_server) == {}
+
+
+def test_jobs_are_deleted_after_an_early_stop(tmp_path, mock_server,
+                                              monkeypatch):
+    monkeypatch.setattr(
+        Registry, 'search_registries',
+        lambda rsp, number_of_registries: [
+            TapArchive(access_url=mock_server.get_archive_url(i))
+            for i in range(NUMBER_OF_ARCHIVES)])
+
+    urls = run_tool(tmp_path, get_inputs(
+        {'archive_type': 'registry',
+         'keyword': 'mock',
+         'service_type': 'TAP',
+         'wavebands': 'all'},
+        2))
+
+    assert len(urls) == 2
+    assert mock_server.server.job_count == NUMBER_OF_ARCHIVES
+    assert wait_for_jobs(mock_server) == {}
+
+
+@pytest.mark.parametrize('mock_server', [{'async_jobs': False}],
+                         indirect=True)
+def test_failed_submission_falls_back_to_a_sync_query(tmp_path,
+                                                      mock_server):
+    urls = run_tool(tmp_path, get_inputs(
+        {'archive_type': 'archive', 'archive': mock_server.get_archive_url()},
+        3))
+
+    assert len(urls) == 3
+    assert mock_server.server.job_count == 0
@@ -0,0 +1,37 @@
+import subprocess
+import sys
+
+from conftest import TOOL_DIRECTORY
+
+IMPORT_TIME_BUDGET = 0.5
+DEFERRED_MODULES = ['astropy', 'numpy', 'pyarrow', 'pyvo']
+
+
+def import_tool():
+    output = subprocess.run(
+        [sys.executable, '-c',
+         'import sys, time; start = time.perf_counter(); '
+         'import astronomical_archives; '
+         'print(time.perf_counter() - start); '
+         'print(*sorted(name for name in sys.modules '
+         'if name.split(".")[0] in %r))' % DEFERRED_MODULES],
+        cwd=TOOL_DIRECTORY,
+        stdout=subprocess.PIPE,
+        check=True)
+
+    lines = output.stdout.decode().splitlines()
+
+    return float(lines[0]), lines[1].split()
+
+
+def test_heavy_modules_are_deferred():
+    _, eager_modules = import_tool()
+
+    assert eager_modules == []
+
+
+def test_import_time_budget():
+    # the best of a few imports, a busy machine only slows some of them
+    import_time = min(import_tool()[0] for _ in range(3))
+
+    assert import_time < IMPORT_TIME_BUDGET
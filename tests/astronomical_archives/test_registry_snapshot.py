@@ -0,0 +1,82 @@
+import json
+import os
+
+from astronomical_archives import RegistrySearchParameters, RegistrySnapshot
+
+from conftest import TEST_DATA_DIRECTORY
+
+import pytest
+
+LOC_FILE = os.path.join(TEST_DATA_DIRECTORY, 'astronomical_archives_gen.loc')
+REGISTRY_DUMP = os.path.join(TEST_DATA_DIRECTORY,
+                             'astronomical_archives_registry.json')
+
+
+@pytest.fixture
+def snapshot(tmp_path):
+    snapshot = RegistrySnapshot(str(tmp_path / 'registry.sqlite'))
+    snapshot.build([LOC_FILE], [REGISTRY_DUMP])
+
+    return snapshot
+
+
+def search(snapshot, keyword=None, waveband=None):
+    parameters = RegistrySearchParameters(keyword=keyword,
+                                          waveband=waveband,
+                                          service_type='TAP')
+
+    return [record['access_url'] for record in
+            snapshot.search(parameters.get_parameters())]
+
+
+def get_dump_urls():
+    with open(REGISTRY_DUMP, 'r') as dump:
+        return {record['access_url'] for record in json.load(dump)}
+
+
+def get_loc_urls():
+    with open(LOC_FILE, 'r') as loc:
+        return [line.rstrip('\n').split('\t')[2] for line in loc
+                if line.strip() and not line.startswith('#')]
+
+
+def test_build_merges_duplicate_services(tmp_path):
+    snapshot = RegistrySnapshot(str(tmp_path / 'registry.sqlite'))
+
+    number_of_records = snapshot.build([LOC_FILE], [REGISTRY_DUMP])
+
+    assert number_of_records == len(set(get_loc_urls()) | get_dump_urls())
+    assert len(search(snapshot)) == number_of_records
+
+
+def test_search_keeps_the_data_table_order(snapshot):
+    loc_urls = list(dict.fromkeys(get_loc_urls()))
+
+    assert search(snapshot)[:len(loc_urls)] == loc_urls
+
+
+def test_search_matches_every_keyword(snapshot):
+    assert search(snapshot, 'chandra x-ray') == \
+        ['https://cda.harvard.edu/cxctap']
+    assert search(snapshot, 'chandra radio') == []
+
+    # fields of a duplicate record complete the first one
+    assert search(snapshot, 'rave dachs') == ['http://gavo.aip.de/tap']
+
+
+def test_search_escapes_like_wildcards(snapshot):
+    assert search(snapshot, '100%') == ['https://cda.harvard.edu/cxctap']
+    assert search(snapshot, '1_0%') == []
+    assert search(snapshot, '%') == ['https://cda.harvard.edu/cxctap']
+
+
+def test_search_by_waveband(snapshot):
+    optical = search(snapshot, waveband='Optical')
+    uv = search(snapshot, waveband='Ultra violet')
+
+    assert 'http://dc.zah.uni-heidelberg.de/tap' in optical
+    assert 'http://dc.zah.uni-heidelberg.de/tap' in uv
+    assert 'https://cda.harvard.edu/cxctap' not in optical
+
+    # records of the archives data table have no waveband to filter on
+    assert set(get_loc_urls()) - get_dump_urls() <= set(uv)
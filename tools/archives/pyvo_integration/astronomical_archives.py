@@ -1,1289 +1,4247 @@
+import argparse
+import base64
+import concurrent.futures
+import contextlib
+import contextvars
+import csv
 import errno
+import fcntl
 import functools
+import hashlib
+import importlib
+import io
+import itertools
 import json
+import numbers
 import os
+import re
+import shutil
 import signal
+import socket
+import socketserver
+import sqlite3
+import struct
 import sys
-import urllib
-from urllib import request
+import tempfile
+import threading
+import time
+import urllib.parse
+import xml.etree.ElementTree
+import xml.sax.saxutils
 
-from astropy.coordinates import SkyCoord
+import requests
 
-import pyvo
-from pyvo import DALAccessError, DALQueryError, DALServiceError
-from pyvo import registry
+from urllib3.exceptions import ReadTimeoutError
 
 
 MAX_ALLOWED_ENTRIES = 100
 MAX_REGISTRIES_TO_SEARCH = 100
+MAX_QUERY_WORKERS = 10
+MAX_POOLED_HOSTS = 100
+MAX_CONNECTIONS_PER_HOST = 10
+MAX_DOWNLOAD_WORKERS = 8
+MAX_DOWNLOADS_PER_HOST = 4
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_CONNECT_TIMEOUT = 10
+DOWNLOAD_FIRST_BYTE_TIMEOUT = 60
+DOWNLOAD_TIMEOUT = 6 * 3600
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_RETRY_BACKOFF = 1
+MAX_DOWNLOAD_FILE_SIZE = 10 * 1024 ** 3
+MAX_DOWNLOAD_TOTAL_SIZE = 50 * 1024 ** 3
+ARCHIVE_CONNECT_TIMEOUT = 5
+ARCHIVE_FIRST_BYTE_TIMEOUT = 10
+ARCHIVE_QUERY_TIMEOUT = 60
+ARCHIVE_ASYNC_QUERY_TIMEOUT = 600
+ASYNC_POLL_INTERVAL = 0.25
+ASYNC_MAX_POLL_INTERVAL = 5
+TAP_QUERY_MODE = 'sync'
+MAX_INIT_WORKERS = 10
+ARCHIVE_INIT_TIMEOUT = 30
+
+CACHE_DIRECTORY = os.environ.get(
+    'ASTRONOMICAL_ARCHIVES_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'astronomical_archives'))
+EXPORT_BATCH_SIZE = 10000
+EXPORT_BUFFER_SIZE = 1024 * 1024
+EXPORT_FORMATS = ['csv', 'parquet', 'votable']
+
+SCHEMA_CACHE_TTL = 7 * 24 * 3600
+SCHEMA_CACHE_MAX_ENTRIES = 500
+LAZY_SCHEMA_LOADING = True
+REGISTRY_CACHE_TTL = 24 * 3600
+REGISTRY_CACHE_STALE_TTL = 7 * 24 * 3600
+REGISTRY_CACHE_EMPTY_TTL = 600
+REGISTRY_CACHE_MAX_ENTRIES = 1000
+REGISTRY_CACHE_STALE_WHILE_REVALIDATE = True
+DOWNLOAD_CACHE_DIRECTORY = os.environ.get(
+    'ASTRONOMICAL_ARCHIVES_DOWNLOAD_CACHE', '')
+DOWNLOAD_CACHE_TTL = 30 * 24 * 3600
+DOWNLOAD_CACHE_MAX_ENTRIES = 100000
+DOWNLOAD_CACHE_MAX_SIZE = 100 * 1024 ** 3
+
+NAME_RESOLVER_CACHE_TTL = 90 * 24 * 3600
+NAME_RESOLVER_CACHE_MAX_ENTRIES = 10000
+NAME_RESOLVER_TIMEOUT = 30
+MAX_RESOLVER_WORKERS = 10
+MAX_TARGET_WORKERS = 4
+MAX_BATCH_TARGETS = 1000
+MAX_BATCH_ENTRIES = 10 * MAX_ALLOWED_ENTRIES
+NAME_RESOLVER_PRELOAD = os.environ.get(
+    'ASTRONOMICAL_ARCHIVES_TARGETS', '')
+
+ARCHIVE_HEALTH_TTL = 30 * 24 * 3600
+ARCHIVE_HEALTH_MAX_ENTRIES = 5000
+ARCHIVE_HEALTH_FAILURE_THRESHOLD = 3
+ARCHIVE_HEALTH_RETRY_DELAY = 3600
+ARCHIVE_HEALTH_MAX_RETRY_DELAY = 7 * 24 * 3600
+ARCHIVE_HEALTH_LATENCY_WEIGHT = 0.3
+ARCHIVE_HEALTH_UNKNOWN_LATENCY = 5
+ARCHIVE_HEALTH_LATENCY_BUCKET = 2
+ARCHIVE_HEALTH_OBSCORE_TTL = 7 * 24 * 3600
+
+TRACE_ENABLED = os.environ.get('ASTRONOMICAL_ARCHIVES_TRACE', '') == '1'
+TRACE_FILE = 'trace.json'
+
+DAEMON_SOCKET = os.environ.get('ASTRONOMICAL_ARCHIVES_DAEMON', '')
+DAEMON_MAX_JOBS = 16
+DAEMON_CONNECT_TIMEOUT = 5
+DAEMON_ENVIRONMENT_PREFIXES = ('ASTRONOMICAL_ARCHIVES_', 'IVOA_REGISTRY')
+DAEMON_JOB_ENVIRONMENT = ['ASTRONOMICAL_ARCHIVES_DAEMON',
+                          'ASTRONOMICAL_ARCHIVES_TRACE']
+DAEMON_PRELOAD = ['numpy', 'pyvo', 'astropy.coordinates',
+                  'astropy.io.votable']
+
+REGISTRY_SNAPSHOT = os.environ.get(
+    'ASTRONOMICAL_ARCHIVES_REGISTRY_SNAPSHOT', '')
+REGISTRY_LIVE_SEARCH = \
+    os.environ.get('ASTRONOMICAL_ARCHIVES_REGISTRY_LIVE', '') == '1'
+
+
+class LazyModule:
+    """
+    Module imported on first attribute access, astropy and pyvo take
+    most of the start up time and are not needed by every run
+    """
 
+    def __init__(self, name):
+        self._name = name
+        self._module = None
 
-class TimeoutException(Exception):
-    pass
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
 
+        return getattr(self._module, attribute)
 
-def timeout(seconds=10, error_message=os.strerror(errno.ETIME)):
-    def decorator(func):
-        def _handle_timeout(signum, frame):
-            raise TimeoutException(error_message)
 
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            signal.signal(signal.SIGALRM, _handle_timeout)
-            signal.alarm(seconds)
-            try:
-                result = func(*args, **kwargs)
-            finally:
-                signal.alarm(0)
-            return result
+numpy = LazyModule('numpy')
+pyvo = LazyModule('pyvo')
+astropy_coordinates = LazyModule('astropy.coordinates')
+astropy_votable = LazyModule('astropy.io.votable')
 
-        return wrapper
 
-    return decorator
+class TimeoutException(Exception):
+    pass
 
 
-class Service:
-    # https://pyvo.readthedocs.io/en/latest/api/pyvo.registry.Servicetype.html
+class DownloadBudgetException(Exception):
+    pass
 
-    services = {
-        'TAP': 'tap',
-        'SIA': 'sia',
-        'SIA2': 'sia2',
-        'SPECTRUM': 'spectrum',
-        'SCS': 'scs',
-        'LINE': 'line'
-    }
 
-    supported_services = {
-        'TAP': 'tap'
-    }
+class Deadline:
+    """
+    Time limits of a network operation. connect and first_byte apply to
+    every request made while the deadline is active, total to the whole
+    operation including the transfer of the response
+    """
 
-    def __init__(self):
-        pass
+    _current = contextvars.ContextVar('deadline', default=None)
 
-    @staticmethod
-    def is_service_supported(service_type) -> bool:
-        is_supported = True
+    def __init__(self,
+                 total,
+                 connect=ARCHIVE_CONNECT_TIMEOUT,
+                 first_byte=ARCHIVE_FIRST_BYTE_TIMEOUT):
 
-        if service_type not in Service.services.keys():
-            is_supported = False
-        elif service_type not in Service.supported_services.keys():
-            is_supported = False
+        self.total = total
+        self.connect = connect
+        self.first_byte = first_byte
+        self.expires_at = time.monotonic() + total
+        self._token = None
 
-        return is_supported
+    def __enter__(self):
+        self._token = Deadline._current.set(self)
+        return self
 
+    def __exit__(self, exc_type, exc_value, traceback):
+        Deadline._current.reset(self._token)
 
-class Waveband:
-    # https://pyvo.readthedocs.io/en/latest/api/pyvo.registry.Waveband.html
-    # https://www.ivoa.net/rdf/messenger/2020-08-26/messenger.html
+    def remaining(self):
+        return self.expires_at - time.monotonic()
 
-    wavebands = {
-        'Extreme UV': 'EUV',
-        'Gamma ray': 'Gamma-ray',
-        'Infrared': 'Infrared',
-        'Millimeter': 'Millimeter',
-        'Neutrino': 'Neutrino',
-        'Optical': 'Optical',
-        'Photon': 'Photon',
-        'Radio': 'Radio',
-        'Ultra violet': 'UV',
-        'X-ray': 'X-ray'
-    }
+    def check(self):
+        if self.remaining() <= 0:
+            raise TimeoutException(os.strerror(errno.ETIME))
 
-    def __init__(self):
-        pass
+    def get_request_timeout(self):
+        self.check()
+
+        return (min(self.connect, self.remaining()),
+                min(self.first_byte, self.remaining()))
 
     @staticmethod
-    def is_waveband_supported(waveband) -> bool:
-        is_supported = True
+    def get_current():
+        return Deadline._current.get()
 
-        if waveband not in Waveband.wavebands.keys():
-            is_supported = False
+    @staticmethod
+    def check_current():
+        current_deadline = Deadline.get_current()
 
-        return is_supported
+        if current_deadline is not None:
+            current_deadline.check()
 
 
-class TapArchive:
-    # https://www.ivoa.net/documents/ObsCore/20170509/REC-ObsCore-v1.1-20170509
+def deadline(total,
+             connect=ARCHIVE_CONNECT_TIMEOUT,
+             first_byte=ARCHIVE_FIRST_BYTE_TIMEOUT):
+    def decorator(func):
 
-    service_type = Service.services['TAP']
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with Deadline(total, connect, first_byte):
+                return func(*args, **kwargs)
 
-    def __init__(self,
-                 id=1,
-                 title="Unknown title",
-                 name="Unknown name",
-                 access_url=""):
+        return wrapper
 
-        self.id = id,
-        self.title = title,
-        self.name = name,
-        self.access_url = access_url
-        self.initialized = False
-        self.archive_service = None
-        self.tables = None
+    return decorator
 
-    @timeout(10)
-    def get_resources(self,
-                      query,
-                      number_of_results,
-                      url_field='access_url'):
 
-        resource_list_hydrated = []
+class Span:
+    """
+    Timed section of a run, with counters such as rows or bytes
+    """
 
-        error_message = None
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.start = None
+        self.duration = None
 
-        if self.initialized:
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
 
-            try:
-                raw_resource_list = self.archive_service.search(query)
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.monotonic() - self.start
 
-                for i, resource in enumerate(raw_resource_list):
-                    if i < number_of_results:
-                        resource_list_hydrated.append(
-                            self._get_resource_object(resource))
-                    else:
-                        break
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
 
-            except DALQueryError:
-                if self.has_obscore_table():
-                    error_message = "Error in query -> " + query
-                    Logger.create_action_log(
-                        Logger.ACTION_ERROR,
-                        Logger.ACTION_TYPE_DOWNLOAD,
-                        error_message)
-                else:
-                    error_message = "No obscore table in the archive"
-                    Logger.create_action_log(
-                        Logger.ACTION_ERROR,
-                        Logger.ACTION_TYPE_DOWNLOAD,
-                        error_message)
+        Tracer.record(self)
 
-            except DALServiceError:
-                error_message = "Error communicating with the service"
-                Logger.create_action_log(
-                    Logger.ACTION_ERROR,
-                    Logger.ACTION_TYPE_DOWNLOAD,
-                    error_message)
+    def set(self, **attributes):
+        self.attributes.update(attributes)
 
-            except Exception:
-                error_message = "Unknow error while querying the service"
-                Logger.create_action_log(
-                    Logger.ACTION_ERROR,
-                    Logger.ACTION_TYPE_DOWNLOAD,
-                    error_message)
 
-        return resource_list_hydrated, error_message
+class NoopSpan:
 
-    def _get_resource_object(self, resource):
-        resource_hydrated = {}
+    def __enter__(self):
+        return self
 
-        for key, value in resource.items():
-            resource_hydrated[key] = value
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
 
-        return resource_hydrated
+    def set(self, **attributes):
+        pass
 
-    def initialize(self):
-        error_message = None
 
-        try:
-            self._get_service()
+class Trace:
+    """
+    Spans of a run, each daemon job has its own
+    """
 
-            if self.archive_service:
-                self._set_archive_tables()
-                self.initialized = True
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.spans = []
+        self.origin = time.monotonic()
 
-        except DALAccessError:
-            error_message = \
-                "A connection to the service could not be established"
-            Logger.create_action_log(
-                Logger.ACTION_ERROR,
-                Logger.ACTION_TYPE_ARCHIVE_CONNECTION,
-                error_message)
 
-        except Exception:
-            error_message = "Unknow error while initializing TAP service"
-            Logger.create_action_log(
-                Logger.ACTION_ERROR,
-                Logger.ACTION_TYPE_ARCHIVE_CONNECTION,
-                error_message)
+class Tracer:
+    """
+    Collects the spans of the current run and writes them as a JSON
+    trace. When disabled every span is the same no-op object
+    """
 
-        return self.initialized, error_message
+    _current = contextvars.ContextVar('trace',
+                                      default=Trace(TRACE_ENABLED))
+    _lock = threading.Lock()
+    _noop_span = NoopSpan()
 
-    def _get_service(self):
-        if self.access_url:
-            self.archive_service = pyvo.dal.TAPService(self.access_url)
+    def __init__(self):
+        pass
 
-    def _set_archive_tables(self):
+    @staticmethod
+    def is_enabled():
+        return Tracer._current.get().enabled
 
-        self.tables = []
+    @staticmethod
+    def span(name, **attributes):
+        if not Tracer.is_enabled():
+            return Tracer._noop_span
 
-        for table in self.archive_service.tables:
-            archive_table = {
-                'name': table.name,
-                'type': table.type,
-                'fields': None
-            }
+        return Span(name, attributes)
 
-            fields = []
+    @staticmethod
+    def record(span):
+        trace = Tracer._current.get()
+
+        trace_span = {
+            'name': span.name,
+            'start': round(span.start - trace.origin, 6),
+            'duration': round(span.duration, 6),
+            'thread': threading.current_thread().name,
+            'attributes': span.attributes
+        }
 
-            for table_field in table.columns:
-                field = {
-                    'name': table_field.name,
-                    'description': table_field.description,
-                    'unit': table_field.unit,
-                    'datatype': table_field.datatype.content
-                }
+        with Tracer._lock:
+            trace.spans.append(trace_span)
 
-                fields.append(field)
+    @staticmethod
+    def get_trace():
+        trace = Tracer._current.get()
 
-            archive_table['fields'] = fields
+        with Tracer._lock:
+            spans = sorted(trace.spans, key=lambda span: span['start'])
 
-            self.tables.append(archive_table)
+        return {'spans': spans}
 
-    def _is_query_valid(self, query) -> bool:
-        is_valid = True
+    @staticmethod
+    def write_trace(output):
+        if not Tracer.is_enabled():
+            return
 
-        attribute_from = 'from'
-        attribute_where = 'where'
+        with open(output, 'w') as trace_output:
+            json.dump(Tracer.get_trace(), trace_output, indent=1,
+                      default=str)
 
-        idx_from = query.index(attribute_from)
-        idx_where = query.index(attribute_where)
+    @staticmethod
+    def reset(enabled=TRACE_ENABLED):
+        Tracer._current.set(Trace(enabled))
 
-        table_name = ''
 
-        for idx in range(idx_from + len('from') + 1, idx_where):
-            table_name = table_name + query[idx]
+def traced(name):
+    """
+    Record a span for each call, tagged with the archive url when the
+    method belongs to an archive
+    """
+    def decorator(func):
 
-        if not next(
-                (item for item in self.tables if
-                 item["name"] == table_name),
-                False):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not Tracer.is_enabled():
+                return func(*args, **kwargs)
 
-            is_valid = False
+            access_url = getattr(args[0], 'access_url', None) \
+                if args else None
 
-        return is_valid
+            with Tracer.span(name, archive=access_url):
+                return func(*args, **kwargs)
 
-    def has_obscore_table(self) -> bool:
-        has_obscore_table = self._has_table("ivoa.obscore")
+        return wrapper
 
-        return has_obscore_table
+    return decorator
 
-    def _has_table(self, table_name) -> bool:
-        _has_table = False
 
-        _has_table = next(
-            (item for item in self.tables if item["name"] == table_name),
-            False)
+class DeadlineSession(requests.Session):
+    """
+    Pooled keep-alive requests session applying the connect and first byte
+    limits of the active Deadline to every request. A single shared
+    instance is handed to the pyvo services and the downloader
+    """
 
-        return _has_table
+    _shared = None
+    _shared_lock = threading.Lock()
 
-    def get_archive_name(self, archive_type):
-        try:
-            if archive_type == 'registry':
-                name = str(self.title).strip("',()")
-            else:
-                name = self.access_url
-        except Exception:
-            name = 'Unknown archive title'
+    def __init__(self,
+                 max_hosts=MAX_POOLED_HOSTS,
+                 max_connections_per_host=MAX_CONNECTIONS_PER_HOST):
 
-        return name
+        super().__init__()
+        self.headers['User-Agent'] = pyvo.utils.http.DEFAULT_USER_AGENT
 
+        self.max_connections_per_host = max_connections_per_host
+        self._host_semaphores = {}
+        self._lock = threading.Lock()
 
-class ConeService(TapArchive):
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=max_hosts,
+            pool_maxsize=max_connections_per_host)
 
-    def _get_service(self):
-        if self.access_url:
-            self.archive_service = pyvo.dal.SCSService(self.access_url)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
 
-    def get_resources_from_service_list(self, service_list, target, radius):
+    @staticmethod
+    def get_shared():
+        with DeadlineSession._shared_lock:
+            if DeadlineSession._shared is None:
+                DeadlineSession._shared = DeadlineSession()
 
-        resource_list_hydrated = []
+            return DeadlineSession._shared
 
-        for service in service_list:
-            resources = service.search(target, radius)
-            for i in range(resources.__len__()):
-                resource_url = resources.getrecord(i).getdataurl()
-                if resource_url:
-                    resource_list_hydrated.append(resource_url)
+    def request(self, method, url, **kwargs):
+        current_deadline = Deadline.get_current()
+        semaphore_timeout = None
 
-        return resource_list_hydrated
+        if current_deadline is not None:
+            semaphore_timeout = max(0, current_deadline.remaining())
 
+            if kwargs.get('timeout') is None:
+                kwargs['timeout'] = current_deadline.get_request_timeout()
 
-class RegistrySearchParameters:
+        host_semaphore = self._get_host_semaphore(url)
 
-    def __init__(self, keyword=None, waveband=None, service_type=None):
-        self.keyword = keyword
-        self.waveband = waveband
-        self.service_type = service_type
+        # limits the requests waiting for a response on one host, the
+        # streaming of response bodies is bounded by the callers
+        if not host_semaphore.acquire(timeout=semaphore_timeout):
+            raise TimeoutException('no connection available for ' + url)
 
-    def get_parameters(self):
+        try:
+            return super().request(method, url, **kwargs)
+        except requests.exceptions.Timeout as e:
+            raise TimeoutException(str(e))
+        finally:
+            host_semaphore.release()
 
-        parameters = {
-            'keywords': '',
-            'waveband': '',
-            'service_type': ''
-        }
+    def _get_host_semaphore(self, url):
+        host = urllib.parse.urlparse(url).netloc
 
-        if self.keyword:
-            parameters['keywords'] = self.keyword
+        with self._lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = \
+                    threading.BoundedSemaphore(self.max_connections_per_host)
 
-        if Waveband.is_waveband_supported(self.waveband):
-            parameters['waveband'] = \
-                Waveband.wavebands[self.waveband]
+            return self._host_semaphores[host]
 
-        if Service.is_service_supported(self.service_type):
-            parameters['service_type'] = \
-                Service.services[self.service_type]
-        else:
-            parameters['service_type'] = Service.services['TAP']
 
-        return parameters
+class TaskPool:
+    poll_interval = 0.1
 
+    def __init__(self, max_workers, task_timeout=None):
+        self.max_workers = max_workers
+        self.task_timeout = task_timeout
 
-class Registry:
+    def map(self, func, items):
+        """
+        Run func on every item in a bounded thread pool and yield
+        (item, result, exception) tuples in the order of items.
+        Each task has task_timeout seconds from the moment it starts,
+        closing the generator cancels the tasks not started yet.
+        The workers are daemon threads, tasks still running when the
+        generator is closed do not delay the end of the process.
+        Tasks run in a copy of the caller context, with its deadline,
+        logs and trace
+        """
 
-    def __init__(self):
-        pass
+        items = list(items)
+        started = {}
+        futures = [concurrent.futures.Future() for _ in items]
+        context = contextvars.copy_context()
 
-    @staticmethod
-    def search_registries(rsp: RegistrySearchParameters,
-                          number_of_registries):
+        tasks = iter(list(enumerate(items)))
+        tasks_lock = threading.Lock()
 
-        parameters = rsp.get_parameters()
+        def _run():
+            while True:
+                with tasks_lock:
+                    task = next(tasks, None)
 
-        keywords = parameters['keywords']
-        waveband = parameters['waveband']
-        service_type = parameters['service_type']
+                if task is None:
+                    return
 
-        if not waveband:
-            registry_list = registry.search(
-                keywords=keywords,
-                servicetype=service_type)
-        else:
-            registry_list = registry.search(
-                keywords=keywords,
-                waveband=waveband,
-                servicetype=service_type)
+                index, item = task
 
-        if registry_list:
-            registry_list = Registry._get_registries_from_list(
-                registry_list,
-                number_of_registries)
+                if not futures[index].set_running_or_notify_cancel():
+                    continue
 
-        return registry_list
+                started[index] = time.monotonic()
 
-    @staticmethod
-    def _get_registries_from_list(registry_list, number_of_registries):
+                try:
+                    result = context.copy().run(func, item)
+                except BaseException as e:
+                    futures[index].set_exception(e)
+                else:
+                    futures[index].set_result(result)
 
-        archive_list = []
+        for _ in range(max(1, min(self.max_workers, len(items)))):
+            threading.Thread(target=_run, daemon=True).start()
 
-        for i, ivoa_registry in enumerate(registry_list):
-            if i < number_of_registries:
-                archive = TapArchive(ivoa_registry.standard_id,
-                                     ivoa_registry.res_title,
-                                     ivoa_registry.short_name,
-                                     ivoa_registry.access_url)
+        try:
+            for index, (item, future) in enumerate(zip(items, futures)):
+                try:
+                    result = self._get_result(future, index, started)
+                    yield item, result, None
+                except Exception as e:
+                    yield item, None, e
+        finally:
+            for future in futures:
+                future.cancel()
 
-                archive_list.append(archive)
+    def _get_result(self, future, index, started):
+        while not future.done():
+            wait_time = TaskPool.poll_interval
 
-        return archive_list
+            if self.task_timeout is not None and index in started:
+                remaining = \
+                    started[index] + self.task_timeout - time.monotonic()
 
+                if remaining <= 0:
+                    future.cancel()
+                    raise TimeoutException(os.strerror(errno.ETIME))
 
-class ConeServiceRegistry:
+                wait_time = min(wait_time, remaining)
 
-    def __init__(self):
-        pass
+            concurrent.futures.wait([future], timeout=wait_time)
 
-    @staticmethod
-    def search_services(keyword, number_of_registries):
+        return future.result()
 
-        service_list = []
 
-        service_list = registry.search(servicetype="scs", keywords=keyword)
+class FileCache:
+    """
+    JSON file store shared by every process of the node, one file per key.
+    Any error while reading or writing is treated as a cache miss
+    """
 
-        if service_list:
-            service_list = service_list[:number_of_registries]
+    def __init__(self, name, ttl, max_entries, directory=CACHE_DIRECTORY):
+        self.directory = os.path.join(directory, name)
+        self.ttl = ttl
+        self.max_entries = max_entries
 
-        return service_list
+    def get(self, key):
+        value, age = self.get_with_age(key)
 
+        if value is None or age > self.ttl:
+            return None
 
-class TapQuery:
+        return value
 
-    def __init__(self, query):
-        self.raw_query = query
+    def get_with_age(self, key):
+        entry = self._read_entry(key)
 
-    def get_query(self):
-        return urllib.parse.unquote(self.raw_query).replace("+", " ")
+        if entry is None:
+            return None, None
 
+        return entry['value'], time.time() - entry['timestamp']
 
-class BaseADQLQuery:
+    def set(self, key, value):
+        entry = {
+            'key': key,
+            'timestamp': time.time(),
+            'value': value
+        }
 
-    def __init__(self):
-        pass
+        try:
+            os.makedirs(self.directory, exist_ok=True)
 
-    def _get_order_by_clause(self, order_type):
-        order_by_clause = 'ORDER BY ' + order_type
+            file_descriptor, tmp_path = tempfile.mkstemp(
+                dir=self.directory, suffix='.tmp')
+        except OSError:
+            return
+
+        try:
+            with os.fdopen(file_descriptor, 'w') as cache_file:
+                json.dump(entry, cache_file, default=str)
+
+            os.replace(tmp_path, self._get_path(key))
+
+            self._evict()
+        except (OSError, TypeError, ValueError):
+            # values that cannot be serialized leave a partial file
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def invalidate(self, key):
+        try:
+            os.remove(self._get_path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for path in self._get_entry_paths():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _read_entry(self, key):
+        try:
+            with open(self._get_path(key), 'r') as cache_file:
+                entry = json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+
+        if entry.get('key') != key:
+            return None
+
+        # Entries are evicted by mtime, refreshing it on read makes the
+        # eviction least recently used
+        try:
+            os.utime(self._get_path(key))
+        except OSError:
+            pass
+
+        return entry
+
+    def _evict(self):
+        paths = self._get_entry_paths()
+
+        if len(paths) <= self.max_entries:
+            return
+
+        paths.sort(key=lambda path: os.path.getmtime(path))
+
+        for path in paths[:len(paths) - self.max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _get_entry_paths(self):
+        try:
+            return [os.path.join(self.directory, file_name)
+                    for file_name in os.listdir(self.directory)
+                    if file_name.endswith('.json')]
+        except OSError:
+            return []
+
+    def _get_path(self, key):
+        file_name = hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+        return os.path.join(self.directory, file_name + '.json')
+
+
+class ArchiveHealth:
+    """
+    Per archive record of past runs: init and query latencies (moving
+    averages), timeouts and obscore availability. Archives failing
+    ARCHIVE_HEALTH_FAILURE_THRESHOLD times in a row are skipped until a
+    retry delay, doubling on each further failure, has passed.
+    The updates of a run are kept in memory and written by flush
+    """
+
+    store = FileCache('health',
+                      ARCHIVE_HEALTH_TTL,
+                      ARCHIVE_HEALTH_MAX_ENTRIES)
+
+    _lock = threading.Lock()
+    _updates = {}
+
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def get(access_url):
+        health = ArchiveHealth._read(access_url)
+
+        with ArchiveHealth._lock:
+            updates = list(ArchiveHealth._updates.get(access_url, []))
+
+        for update in updates:
+            update(health)
+
+        return health
+
+    @staticmethod
+    def _read(access_url):
+        health = ArchiveHealth.store.get(access_url) or {}
+
+        return {
+            'init_latency': health.get('init_latency'),
+            'query_latency': health.get('query_latency'),
+            'attempts': health.get('attempts', 0),
+            'timeouts': health.get('timeouts', 0),
+            'consecutive_failures': health.get('consecutive_failures', 0),
+            'last_failure': health.get('last_failure'),
+            'has_obscore': health.get('has_obscore'),
+            'obscore_checked': health.get('obscore_checked')
+        }
+
+    @staticmethod
+    def _add_update(access_url, update):
+        with ArchiveHealth._lock:
+            ArchiveHealth._updates.setdefault(access_url, []).append(update)
+
+    @staticmethod
+    def record_success(access_url, phase, latency):
+        ArchiveHealth._add_update(
+            access_url,
+            functools.partial(ArchiveHealth._apply_success, phase, latency))
+
+    @staticmethod
+    def record_failure(access_url, is_timeout=False):
+        ArchiveHealth._add_update(
+            access_url,
+            functools.partial(ArchiveHealth._apply_failure,
+                              is_timeout,
+                              time.time()))
+
+    @staticmethod
+    def record_obscore(access_url, has_obscore):
+        ArchiveHealth._add_update(
+            access_url,
+            functools.partial(ArchiveHealth._apply_obscore,
+                              has_obscore,
+                              time.time()))
+
+    @staticmethod
+    def _apply_success(phase, latency, health):
+        key = phase + '_latency'
+
+        if health[key] is None:
+            health[key] = latency
+        else:
+            health[key] += ARCHIVE_HEALTH_LATENCY_WEIGHT * \
+                (latency - health[key])
+
+        health['attempts'] += 1
+        health['consecutive_failures'] = 0
+
+    @staticmethod
+    def _apply_failure(is_timeout, failure_time, health):
+        health['attempts'] += 1
+        health['consecutive_failures'] += 1
+        health['last_failure'] = failure_time
+
+        if is_timeout:
+            health['timeouts'] += 1
+
+    @staticmethod
+    def _apply_obscore(has_obscore, checked_time, health):
+        health['has_obscore'] = has_obscore
+        health['obscore_checked'] = checked_time
+
+    @staticmethod
+    def flush():
+        """
+        Write the pending updates, applied to the stored records under a
+        file lock so that concurrent runs do not overwrite each other
+        """
+        with ArchiveHealth._lock:
+            updates = ArchiveHealth._updates
+            ArchiveHealth._updates = {}
+
+        if not updates:
+            return
+
+        try:
+            os.makedirs(ArchiveHealth.store.directory, exist_ok=True)
+
+            with open(os.path.join(ArchiveHealth.store.directory, 'lock'),
+                      'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+                for access_url, url_updates in updates.items():
+                    health = ArchiveHealth._read(access_url)
+
+                    for update in url_updates:
+                        update(health)
+
+                    ArchiveHealth.store.set(access_url, health)
+        except OSError:
+            pass
+
+    @staticmethod
+    def is_available(health, now=None):
+        failures = health['consecutive_failures']
+
+        if failures < ARCHIVE_HEALTH_FAILURE_THRESHOLD:
+            return True
+
+        retry_delay = min(
+            ARCHIVE_HEALTH_RETRY_DELAY *
+            2 ** (failures - ARCHIVE_HEALTH_FAILURE_THRESHOLD),
+            ARCHIVE_HEALTH_MAX_RETRY_DELAY)
+
+        now = time.time() if now is None else now
+
+        return now - (health['last_failure'] or 0) >= retry_delay
+
+    @staticmethod
+    def lacks_obscore(health, now=None):
+        now = time.time() if now is None else now
+
+        return health['has_obscore'] is False and \
+            now - (health['obscore_checked'] or 0) < \
+            ARCHIVE_HEALTH_OBSCORE_TTL
+
+    @staticmethod
+    def get_latency_bucket(health):
+        """
+        Init and query latency in steps of ARCHIVE_HEALTH_LATENCY_BUCKET
+        seconds, so that small variations do not reorder archives
+        """
+        latency = (health['init_latency'] or
+                   ARCHIVE_HEALTH_UNKNOWN_LATENCY) + \
+            (health['query_latency'] or ARCHIVE_HEALTH_UNKNOWN_LATENCY)
+
+        return int(latency // ARCHIVE_HEALTH_LATENCY_BUCKET)
+
+    @staticmethod
+    def select(archives, needs_obscore=False):
+        """
+        Drop the archives known to be down, or without obscore table
+        when one is needed, and order the others fastest first. Archives
+        in the same latency bucket keep their registry order. If no
+        archive is left they are all kept, in their original order
+        """
+        selected = []
+
+        for archive in archives:
+            health = ArchiveHealth.get(archive.access_url)
+
+            if ArchiveHealth.is_available(health) and \
+                    not (needs_obscore and
+                         ArchiveHealth.lacks_obscore(health)):
+                selected.append(
+                    (ArchiveHealth.get_latency_bucket(health), archive))
+
+        if not selected:
+            return list(archives)
+
+        # sorted is stable, ties keep the registry order
+        return [archive for _, archive in
+                sorted(selected, key=lambda item: item[0])]
+
+
+class Service:
+    # https://pyvo.readthedocs.io/en/latest/api/pyvo.registry.Servicetype.html
+
+    services = {
+        'TAP': 'tap',
+        'SIA': 'sia',
+        'SIA2': 'sia2',
+        'SPECTRUM': 'spectrum',
+        'SCS': 'scs',
+        'LINE': 'line'
+    }
+
+    supported_services = {
+        'TAP': 'tap'
+    }
+
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def is_service_supported(service_type) -> bool:
+        is_supported = True
+
+        if service_type not in Service.services.keys():
+            is_supported = False
+        elif service_type not in Service.supported_services.keys():
+            is_supported = False
+
+        return is_supported
+
+
+class Waveband:
+    # https://pyvo.readthedocs.io/en/latest/api/pyvo.registry.Waveband.html
+    # https://www.ivoa.net/rdf/messenger/2020-08-26/messenger.html
+
+    wavebands = {
+        'Extreme UV': 'EUV',
+        'Gamma ray': 'Gamma-ray',
+        'Infrared': 'Infrared',
+        'Millimeter': 'Millimeter',
+        'Neutrino': 'Neutrino',
+        'Optical': 'Optical',
+        'Photon': 'Photon',
+        'Radio': 'Radio',
+        'Ultra violet': 'UV',
+        'X-ray': 'X-ray'
+    }
+
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def is_waveband_supported(waveband) -> bool:
+        is_supported = True
+
+        if waveband not in Waveband.wavebands.keys():
+            is_supported = False
+
+        return is_supported
+
+
+class TapArchive:
+    # https://www.ivoa.net/documents/ObsCore/20170509/REC-ObsCore-v1.1-20170509
+
+    service_type = Service.services['TAP']
+
+    # set per run by the ToolRunner
+    init_timeout = ARCHIVE_INIT_TIMEOUT
+    query_timeout = ARCHIVE_QUERY_TIMEOUT
+
+    schema_cache = FileCache('tables',
+                             SCHEMA_CACHE_TTL,
+                             SCHEMA_CACHE_MAX_ENTRIES)
+
+    def __init__(self,
+                 id=1,
+                 title="Unknown title",
+                 name="Unknown name",
+                 access_url="",
+                 lazy_schema=LAZY_SCHEMA_LOADING):
+
+        self.id = id,
+        self.title = title,
+        self.name = name,
+        self.access_url = access_url
+        self.lazy_schema = lazy_schema
+        self.initialized = False
+        self.archive_service = None
+        self.tables = None
+        self._tables_complete = False
+        self._refresh_cache = False
+
+    @traced('archive.query')
+    def get_resources(self,
+                      query,
+                      number_of_results,
+                      url_field='access_url'):
+
+        with Deadline(self.query_timeout):
+            return self._get_resources(
+                query,
+                lambda: self._read_resources(query, number_of_results))
+
+    @traced('archive.submit_job')
+    def submit_job(self, query, number_of_results):
+        with Deadline(self.query_timeout):
+            job = self.archive_service.submit_job(query,
+                                                  maxrec=number_of_results)
+
+            return job.run()
+
+    @traced('archive.job_query')
+    @deadline(ARCHIVE_ASYNC_QUERY_TIMEOUT)
+    def get_job_resources(self, job, query, number_of_results):
+
+        return self._get_resources(
+            query,
+            lambda: self._read_job_resources(job, number_of_results))
+
+    @staticmethod
+    def delete_job(job):
+        try:
+            with Deadline(ARCHIVE_CONNECT_TIMEOUT +
+                          ARCHIVE_FIRST_BYTE_TIMEOUT):
+                job.delete()
+        except Exception:
+            pass
+
+    def _get_resources(self, query, read_resources):
+
+        resource_table = ResourceTable()
+
+        error_message = None
+
+        if self.initialized:
+
+            start = time.monotonic()
+
+            try:
+                resource_table = read_resources()
+
+                ArchiveHealth.record_success(self.access_url,
+                                             'query',
+                                             time.monotonic() - start)
+
+            except pyvo.DALQueryError:
+                if self.has_obscore_table() is False:
+                    ArchiveHealth.record_obscore(self.access_url, False)
+
+                    error_message = "No obscore table in the archive"
+                    Logger.create_action_log(
+                        Logger.ACTION_ERROR,
+                        Logger.ACTION_TYPE_QUERY,
+                        error_message)
+                else:
+                    error_message = "Error in query -> " + query
+                    Logger.create_action_log(
+                        Logger.ACTION_ERROR,
+                        Logger.ACTION_TYPE_QUERY,
+                        error_message)
+
+            except TimeoutException:
+                raise
+
+            except pyvo.DALServiceError:
+                ArchiveHealth.record_failure(self.access_url)
+
+                error_message = "Error communicating with the service"
+                Logger.create_action_log(
+                    Logger.ACTION_ERROR,
+                    Logger.ACTION_TYPE_QUERY,
+                    error_message)
+
+            except Exception:
+                error_message = "Unknown error while querying the service"
+                Logger.create_action_log(
+                    Logger.ACTION_ERROR,
+                    Logger.ACTION_TYPE_QUERY,
+                    error_message)
+
+        return resource_table, error_message
+
+    def _read_resources(self, query, number_of_results):
+        tap_query = self.archive_service.create_query(
+            query,
+            maxrec=number_of_results)
+
+        votable_stream = VOTableStream(tap_query.execute_stream(),
+                                       tap_query.queryurl,
+                                       tap_query.raise_if_error)
+
+        try:
+            return votable_stream.read_table(number_of_results)
+        finally:
+            votable_stream.close()
+
+    def _read_job_resources(self, job, number_of_results):
+        poll_interval = ASYNC_POLL_INTERVAL
+
+        while job.phase not in ['COMPLETED', 'ERROR', 'ABORTED']:
+            time.sleep(max(0, min(poll_interval,
+                                  Deadline.get_current().remaining())))
+            Deadline.check_current()
+
+            poll_interval = min(poll_interval * 2, ASYNC_MAX_POLL_INTERVAL)
+
+        job.raise_if_error()
+
+        if job.result_uri is None:
+            raise pyvo.DALServiceError('No result for the job', url=job.url)
+
+        response = DeadlineSession.get_shared().get(job.result_uri,
+                                                    stream=True)
+
+        if not response.ok:
+            response.close()
+            raise pyvo.DALServiceError('Unable to fetch the job result',
+                                       response.status_code,
+                                       job.result_uri)
+
+        response.raw.read = functools.partial(response.raw.read,
+                                              decode_content=True)
+
+        votable_stream = VOTableStream(response.raw, job.result_uri)
+
+        try:
+            return votable_stream.read_table(number_of_results)
+        finally:
+            votable_stream.close()
+
+    @traced('archive.initialize')
+    def initialize(self, refresh_cache=False):
+        error_message = None
+
+        try:
+            with Deadline(self.init_timeout):
+                self._get_service()
+
+                if self.archive_service:
+                    self._refresh_cache = refresh_cache
+
+                    if not self.lazy_schema:
+                        self._set_archive_tables(refresh_cache)
+
+                    self.initialized = True
+
+        except pyvo.DALAccessError:
+            error_message = \
+                "A connection to the service could not be established"
+            Logger.create_action_log(
+                Logger.ACTION_ERROR,
+                Logger.ACTION_TYPE_ARCHIVE_CONNECTION,
+                error_message)
+
+        except Exception:
+            error_message = "Unknown error while initializing TAP service"
+            Logger.create_action_log(
+                Logger.ACTION_ERROR,
+                Logger.ACTION_TYPE_ARCHIVE_CONNECTION,
+                error_message)
+
+        return self.initialized, error_message
+
+    def _get_service(self):
+        if self.access_url:
+            self.archive_service = pyvo.dal.TAPService(
+                self.access_url,
+                session=DeadlineSession.get_shared())
+
+    @traced('archive.schema')
+    def _set_archive_tables(self, refresh_cache=False):
+
+        if not refresh_cache:
+            self.tables = TapArchive.schema_cache.get(self.access_url)
+
+            # entries of older versions may lack the fields of lazy tables
+            if self.tables is not None and \
+                    all(table['fields'] is not None for table in self.tables):
+                self._tables_complete = True
+                return
+
+        self.tables = []
+        self._tables_complete = False
+
+        for table in self.archive_service.tables:
+            archive_table = {
+                'name': table.name,
+                'type': table.type,
+                'fields': [TapArchive._get_field(table_field)
+                           for table_field in table.columns]
+            }
+
+            self.tables.append(archive_table)
+
+        self._tables_complete = True
+
+        TapArchive.schema_cache.set(self.access_url, self.tables)
+
+    def _set_archive_table_names(self):
+
+        if not self._refresh_cache:
+            # a complete schema already has every table
+            self.tables = TapArchive.schema_cache.get(self.access_url)
+
+            if self.tables is not None:
+                self._tables_complete = True
+                return
+
+            self.tables = TapArchive.schema_cache.get(
+                self._get_names_cache_key())
+
+        # the tables already looked up, the others are looked up when needed
+        if self.tables is None:
+            self.tables = []
+
+    @traced('archive.schema_lookup')
+    def _get_table_from_schema(self, table_name):
+        try:
+            table_list = self.archive_service.search(
+                'SELECT table_name, table_type FROM TAP_SCHEMA.tables '
+                "WHERE table_name = '" + table_name.replace("'", "''") + "'")
+        except (pyvo.DALQueryError, pyvo.DALServiceError):
+            return self._get_table_from_vosi(table_name)
+
+        archive_table = next(
+            ({'name': str(table['table_name']),
+              'type': str(table['table_type']),
+              'fields': None}
+             for table in table_list
+             if str(table['table_name']) == table_name),
+            None)
+
+        if archive_table is None:
+            # a truncated answer does not tell that the table is missing
+            return None if table_list.status[0] == 'OVERFLOW' else False
+
+        self.tables.append(archive_table)
+
+        TapArchive.schema_cache.set(self._get_names_cache_key(), self.tables)
+
+        return archive_table
+
+    def _get_table_from_vosi(self, table_name):
+        # services without a queryable TAP_SCHEMA only expose /tables
+        try:
+            self._set_archive_tables(refresh_cache=True)
+        except Exception:
+            self.tables = []
+            return None
+
+        return self._find_table(table_name) or False
+
+    def _get_names_cache_key(self):
+        # the fields of the tables are only read when needed
+        return 'names:' + self.access_url
+
+    def _get_tables(self):
+        if self.tables is None:
+            self._set_archive_table_names()
+
+        return self.tables
+
+    @traced('archive.table_fields')
+    def get_table_fields(self, table_name):
+        archive_table = self._has_table(table_name)
+
+        if not archive_table:
+            return None
+
+        if archive_table['fields'] is None:
+            try:
+                fields = self._get_table_fields_from_schema(table_name)
+            except (pyvo.DALQueryError, pyvo.DALServiceError):
+                fields = []
+
+            if not fields:
+                fields = self._get_table_fields_from_vosi(table_name)
+
+            archive_table['fields'] = fields
+
+            TapArchive.schema_cache.set(self._get_names_cache_key(),
+                                        self.tables)
+
+        return archive_table['fields']
+
+    def _get_table_fields_from_schema(self, table_name):
+        column_list = self.archive_service.search(
+            'SELECT column_name, description, unit, datatype '
+            'FROM TAP_SCHEMA.columns '
+            "WHERE table_name = '" + table_name.replace("'", "''") + "'")
+
+        return [{
+            'name': str(column['column_name']),
+            'description': TapArchive._get_text(column['description']),
+            'unit': TapArchive._get_text(column['unit']),
+            'datatype': TapArchive._get_text(column['datatype'])
+        } for column in column_list]
+
+    def _get_table_fields_from_vosi(self, table_name):
+        # VOSI endpoint describing a single table
+        tables_url = self.archive_service.baseurl + '/tables/' + table_name
+
+        response = DeadlineSession.get_shared().get(tables_url, stream=True)
+
+        try:
+            if not response.ok:
+                raise pyvo.DALServiceError(
+                    'Unable to fetch the table description',
+                    response.status_code,
+                    tables_url)
+
+            response.raw.read = functools.partial(response.raw.read,
+                                                  decode_content=True)
+
+            table = pyvo.io.vosi.parse_tables(
+                response.raw.read).get_first_table()
+        finally:
+            response.close()
+
+        return [TapArchive._get_field(table_field)
+                for table_field in table.columns]
+
+    @staticmethod
+    def _get_field(table_field):
+        return {
+            'name': table_field.name,
+            'description': table_field.description,
+            'unit': table_field.unit,
+            'datatype': table_field.datatype.content
+        }
+
+    @staticmethod
+    def _get_text(value):
+        if value is None or numpy.ma.is_masked(value):
+            return None
+
+        return str(value)
+
+    def _is_query_valid(self, query) -> bool:
+        is_valid = True
+
+        query_match = re.search(
+            r'SELECT\s+(?:TOP\s+\d+\s+)?(.+?)\s+FROM\s+([\w.]+)',
+            query,
+            re.IGNORECASE | re.DOTALL)
+
+        if query_match is None:
+            return False
+
+        selected_fields = query_match.group(1).strip()
+        table_name = query_match.group(2)
+
+        archive_table = self._has_table(table_name)
+
+        if archive_table is False:
+            is_valid = False
+
+        elif selected_fields != '*' and archive_table:
+            field_names = [field['name'] for field in
+                           self.get_table_fields(table_name)]
+
+            for selected_field in selected_fields.split(','):
+                if selected_field.strip() not in field_names:
+                    is_valid = False
+
+        return is_valid
+
+    def has_obscore_table(self):
+        has_obscore_table = self._has_table("ivoa.obscore")
+
+        return has_obscore_table
+
+    def _has_table(self, table_name):
+        """
+        Description of the table, False when the archive does not have it
+        and None when that could not be found out
+        """
+        archive_table = self._find_table(table_name)
+
+        if archive_table is not None:
+            return archive_table
+
+        if self._tables_complete:
+            return False
+
+        return self._get_table_from_schema(table_name)
+
+    def _find_table(self, table_name):
+        return next(
+            (item for item in self._get_tables()
+             if item["name"] == table_name),
+            None)
+
+    def get_archive_name(self, archive_type):
+        try:
+            if archive_type == 'registry':
+                name = str(self.title).strip("',()")
+            else:
+                name = self.access_url
+        except Exception:
+            name = 'Unknown archive title'
+
+        return name
+
+
+class VOTableStream:
+    """
+    Incremental reader of a TAP response. TABLEDATA rows are parsed
+    one by one into columns, other serializations are handed to the
+    astropy parser once the whole response has been read
+    """
+
+    numeric_types = {
+        'short': int,
+        'int': int,
+        'long': int,
+        'unsignedByte': int,
+        'float': float,
+        'double': float
+    }
+
+    binary_serializations = ['BINARY', 'BINARY2', 'FITS']
+
+    def __init__(self, stream, url, check_response=None):
+        self.stream = stream
+        self.url = url
+        self.check_response = check_response
+        self._fields = []
+        self._parsed_table = None
+        self._buffer = io.BytesIO()
+        self._is_buffering = True
+
+    def read(self, size=-1):
+        Deadline.check_current()
+
+        try:
+            data = self.stream.read(size)
+        except (ReadTimeoutError, TimeoutError) as e:
+            raise TimeoutException(str(e))
+
+        if self._is_buffering:
+            self._buffer.write(data)
+
+        return data
+
+    def close(self):
+        self.stream.close()
+
+        # hands the connection slot back to the shared session pool
+        release_conn = getattr(self.stream, 'release_conn', None)
+
+        if release_conn is not None:
+            release_conn()
+
+    def read_table(self, number_of_results):
+        with Tracer.span('votable.rows', url=self.url) as span:
+            resource_table = self._read_table(number_of_results)
+
+            span.set(rows=len(resource_table),
+                     columns=len(resource_table.keys))
+
+        return resource_table
+
+    def _read_table(self, number_of_results):
+        columns = []
+
+        for row in itertools.islice(self.iter_rows(), number_of_results):
+            if not columns:
+                columns = [[] for _ in row]
+
+            for column, value in zip(columns, row):
+                column.append(value)
+
+        if self._parsed_table is not None:
+            return self._parsed_table.head(number_of_results)
+
+        names = [field.get('name') for field in self._fields]
+
+        return ResourceTable(names, columns or [[] for _ in names])
+
+    def iter_rows(self):
+        row = []
+        has_table = False
+
+        try:
+            for event, element in xml.etree.ElementTree.iterparse(
+                    self, events=('start', 'end')):
+
+                tag = element.tag.rsplit('}', 1)[-1]
+
+                if event == 'start':
+                    if tag == 'TABLEDATA':
+                        has_table = True
+                        # rows are never re-read, stop keeping a copy
+                        self._is_buffering = False
+                        self._buffer = None
+                    elif tag in VOTableStream.binary_serializations:
+                        self._read_parsed_table()
+                        return
+                    continue
+
+                if tag == 'FIELD':
+                    self._fields.append(element.attrib)
+                elif tag == 'INFO':
+                    self._check_query_status(element)
+                elif tag == 'TD':
+                    row.append(element.text)
+                elif tag == 'TR':
+                    yield self._get_row(row)
+                    row = []
+                    element.clear()
+
+        except xml.etree.ElementTree.ParseError:
+            self._check_response()
+            raise pyvo.DALServiceError('Invalid VOTable response',
+                                       url=self.url)
+
+        if not has_table:
+            self._check_response()
+
+    def _check_response(self):
+        if self.check_response is not None:
+            self.check_response()
+
+    def _read_parsed_table(self):
+        self._buffer.write(self.stream.read())
+        self._buffer.seek(0)
+
+        table = pyvo.dal.TAPResults(
+            astropy_votable.parse(self._buffer),
+            url=self.url).to_table()
+
+        self._parsed_table = ResourceTable(
+            table.colnames,
+            [table[name] for name in table.colnames])
+
+    def _check_query_status(self, element):
+        if element.get('name') == 'QUERY_STATUS' and \
+                element.get('value', '').upper() == 'ERROR':
+            raise pyvo.DALQueryError(element.text or 'Query error',
+                                     'ERROR',
+                                     self.url)
+
+    def _get_row(self, row):
+        return tuple(VOTableStream._get_value(field, value)
+                     for field, value in zip(self._fields, row))
+
+    @staticmethod
+    def _get_value(field, value):
+        datatype = field.get('datatype')
+
+        if value is None or value == '':
+            return None if datatype in VOTableStream.numeric_types else ''
+
+        if datatype in VOTableStream.numeric_types and \
+                field.get('arraysize') is None:
+            try:
+                return VOTableStream.numeric_types[datatype](value)
+            except ValueError:
+                return value
+
+        if datatype == 'boolean':
+            return value.strip().lower() in ['t', 'true', '1']
+
+        return value
+
+
+class ConeService(TapArchive):
+
+    def _get_service(self):
+        if self.access_url:
+            self.archive_service = pyvo.dal.SCSService(
+                self.access_url,
+                session=DeadlineSession.get_shared())
+
+    def get_resources_from_service_list(self, service_list, target, radius):
+
+        resource_list_hydrated = []
+
+        for service in service_list:
+            resources = service.search(target, radius)
+            for i in range(resources.__len__()):
+                resource_url = resources.getrecord(i).getdataurl()
+                if resource_url:
+                    resource_list_hydrated.append(resource_url)
+
+        return resource_list_hydrated
+
+
+class RegistrySearchParameters:
+
+    def __init__(self, keyword=None, waveband=None, service_type=None):
+        self.keyword = keyword
+        self.waveband = waveband
+        self.service_type = service_type
+
+    def get_parameters(self):
+
+        parameters = {
+            'keywords': '',
+            'waveband': '',
+            'service_type': ''
+        }
+
+        if self.keyword:
+            parameters['keywords'] = self.keyword
+
+        if Waveband.is_waveband_supported(self.waveband):
+            parameters['waveband'] = \
+                Waveband.wavebands[self.waveband]
+
+        if Service.is_service_supported(self.service_type):
+            parameters['service_type'] = \
+                Service.services[self.service_type]
+        else:
+            parameters['service_type'] = Service.services['TAP']
+
+        return parameters
+
+
+class Registry:
+    search_cache = FileCache('registry',
+                             REGISTRY_CACHE_TTL,
+                             REGISTRY_CACHE_MAX_ENTRIES)
+
+    stale_while_revalidate = REGISTRY_CACHE_STALE_WHILE_REVALIDATE
+
+    snapshot_path = REGISTRY_SNAPSHOT
+    live_search = REGISTRY_LIVE_SEARCH
+
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def search_registries(rsp: RegistrySearchParameters,
+                          number_of_registries):
+
+        parameters = rsp.get_parameters()
+
+        with Tracer.span('registry.search') as span:
+            registry_list = Registry.search_records(
+                parameters,
+                Registry._search_registry_records)
+
+            span.set(records=len(registry_list or []))
+
+        if registry_list:
+            registry_list = Registry._get_registries_from_list(
+                registry_list,
+                number_of_registries)
+
+        return registry_list
+
+    @staticmethod
+    def search_records(parameters, search_function):
+        if not Registry.live_search and Registry.snapshot_path and \
+                os.path.isfile(Registry.snapshot_path):
+            return RegistrySnapshot(Registry.snapshot_path).search(parameters)
+
+        return Registry.cached_search(parameters, search_function)
+
+    @staticmethod
+    def cached_search(parameters, search_function):
+
+        cache_key = Registry._get_cache_key(parameters)
+
+        records, age = Registry.search_cache.get_with_age(cache_key)
+
+        if records is not None:
+            # a search without results is only kept for a short time and
+            # is never served stale
+            if not records:
+                if age <= REGISTRY_CACHE_EMPTY_TTL:
+                    return records
+
+            elif age <= Registry.search_cache.ttl:
+                return records
+
+            elif Registry.stale_while_revalidate and \
+                    age <= REGISTRY_CACHE_STALE_TTL:
+                threading.Thread(
+                    target=Registry._revalidate_search,
+                    args=(cache_key, parameters, search_function),
+                    daemon=True).start()
+
+                return records
+
+        return Registry._refresh_search(cache_key,
+                                        parameters,
+                                        search_function)
+
+    @staticmethod
+    def _refresh_search(cache_key, parameters, search_function):
+        records = search_function(parameters)
+
+        Registry.search_cache.set(cache_key, records)
+
+        return records
+
+    @staticmethod
+    def _revalidate_search(cache_key, parameters, search_function):
+        try:
+            Registry._refresh_search(cache_key, parameters, search_function)
+        except Exception:
+            pass
+
+    @staticmethod
+    def _get_cache_key(parameters):
+        normalized_parameters = {
+            key: str(value).strip().lower()
+            for key, value in parameters.items()
+        }
+
+        return json.dumps(normalized_parameters, sort_keys=True)
+
+    @staticmethod
+    def _search_registry_records(parameters):
+
+        keywords = parameters['keywords']
+        waveband = parameters['waveband']
+        service_type = parameters['service_type']
+
+        if not waveband:
+            registry_list = pyvo.registry.search(
+                keywords=keywords,
+                servicetype=service_type)
+        else:
+            registry_list = pyvo.registry.search(
+                keywords=keywords,
+                waveband=waveband,
+                servicetype=service_type)
+
+        return Registry._get_records_from_list(registry_list)
+
+    @staticmethod
+    def _get_records_from_list(registry_list):
+
+        records = []
+
+        for ivoa_registry in registry_list:
+            try:
+                record = {
+                    'standard_id': ivoa_registry.standard_id,
+                    'res_title': ivoa_registry.res_title,
+                    'short_name': ivoa_registry.short_name,
+                    'access_url': ivoa_registry.access_url,
+                    'waveband': ivoa_registry.waveband,
+                    'res_description': ivoa_registry.res_description
+                }
+            except Exception:
+                continue
+
+            records.append(record)
+
+        return records
+
+    @staticmethod
+    def _get_registries_from_list(registry_list, number_of_registries):
+
+        archive_list = []
+
+        for i, ivoa_registry in enumerate(registry_list):
+            if i < number_of_registries:
+                archive = TapArchive(ivoa_registry['standard_id'],
+                                     ivoa_registry['res_title'],
+                                     ivoa_registry['short_name'],
+                                     ivoa_registry['access_url'])
+
+                archive_list.append(archive)
+
+        return archive_list
+
+
+class ConeServiceRegistry:
+
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def search_services(keyword, number_of_registries):
+
+        service_list = []
+
+        parameters = {
+            'keywords': keyword,
+            'service_type': Service.services['SCS']
+        }
+
+        service_records = Registry.search_records(
+            parameters,
+            ConeServiceRegistry._search_service_records)
+
+        for service_record in service_records[:number_of_registries]:
+            service_list.append(
+                pyvo.dal.SCSService(service_record['access_url'],
+                                    session=DeadlineSession.get_shared()))
+
+        return service_list
+
+    @staticmethod
+    def _search_service_records(parameters):
+
+        service_list = pyvo.registry.search(
+            servicetype=parameters['service_type'],
+            keywords=parameters['keywords'])
+
+        return Registry._get_records_from_list(service_list)
+
+
+class RegistrySnapshot:
+    """
+    Local sqlite index of registry records, built from the archives data
+    table and registry dumps so that searches run without RegTAP
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def search(self, parameters):
+
+        conditions = ['service_type = ?']
+        values = [parameters['service_type'].lower()]
+
+        for keyword in parameters.get('keywords', '').lower().split():
+            conditions.append("search_text LIKE ? ESCAPE '\\'")
+            values.append('%' + RegistrySnapshot._escape_like(keyword) + '%')
+
+        # records without waveband, like the ones of the archives data
+        # table, are not excluded by a waveband
+        if parameters.get('waveband'):
+            conditions.append(
+                '(access_url IN '
+                '(SELECT access_url FROM wavebands WHERE waveband = ?) '
+                'OR access_url NOT IN (SELECT access_url FROM wavebands))')
+            values.append(parameters['waveband'].lower())
+
+        query = 'SELECT standard_id, res_title, short_name, access_url ' \
+                'FROM services WHERE ' + ' AND '.join(conditions) + \
+                ' ORDER BY position'
+
+        with contextlib.closing(sqlite3.connect(self.path)) as connection:
+            connection.row_factory = sqlite3.Row
+            rows = connection.execute(query, values).fetchall()
+
+        return [dict(row) for row in rows]
+
+    def build(self, loc_files=(), registry_dumps=()):
+        records = []
+
+        for loc_file in loc_files:
+            records.extend(RegistrySnapshot._get_records_from_loc(loc_file))
+
+        for registry_dump in registry_dumps:
+            with open(registry_dump, 'r') as dump_file:
+                records.extend(json.load(dump_file))
+
+        records = RegistrySnapshot._merge_records(records)
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+        with contextlib.closing(sqlite3.connect(self.path)) as connection:
+            connection.executescript(RegistrySnapshot.schema)
+
+            for position, record in enumerate(records):
+                self._insert_record(connection, position, record)
+
+            connection.commit()
+
+        return len(records)
+
+    def _insert_record(self, connection, position, record):
+
+        search_text = ' '.join(
+            str(record.get(key) or '') for key in
+            ['res_title', 'short_name', 'res_description']).lower()
+
+        connection.execute(
+            'INSERT INTO services VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [record['access_url'],
+             position,
+             record.get('standard_id', ''),
+             record.get('res_title', ''),
+             record.get('short_name', ''),
+             record.get('service_type', Service.services['TAP']).lower(),
+             search_text])
+
+        for waveband in record.get('waveband') or []:
+            connection.execute(
+                'INSERT INTO wavebands VALUES (?, ?)',
+                [record['access_url'], waveband])
+
+    @staticmethod
+    def _merge_records(records):
+        """
+        Merge the records of a same service, the first one keeps its
+        position and gets the missing fields and the wavebands of the
+        others
+        """
+
+        merged_records = {}
+
+        for record in records:
+            wavebands = [waveband.lower() for waveband in
+                         record.get('waveband') or [] if waveband]
+
+            merged_record = merged_records.get(record['access_url'])
+
+            if merged_record is None:
+                merged_records[record['access_url']] = \
+                    dict(record, waveband=sorted(set(wavebands)))
+                continue
+
+            for key, value in record.items():
+                if value and not merged_record.get(key):
+                    merged_record[key] = value
+
+            merged_record['waveband'] = \
+                sorted(set(merged_record['waveband']) | set(wavebands))
+
+        return list(merged_records.values())
+
+    @staticmethod
+    def _escape_like(value):
+        return value.replace('\\', '\\\\') \
+            .replace('%', '\\%') \
+            .replace('_', '\\_')
+
+    @staticmethod
+    def _get_records_from_loc(loc_file):
+        records = []
+
+        with open(loc_file, 'r') as loc:
+            for line in loc:
+                if line.startswith('#') or not line.strip():
+                    continue
+
+                _, display_name, access_url = \
+                    line.rstrip('\n').split('\t')[:3]
+
+                records.append({
+                    'standard_id': 'ivo://ivoa.net/std/tap',
+                    'res_title': display_name,
+                    'short_name': '',
+                    'access_url': access_url,
+                    'service_type': Service.services['TAP'],
+                    'waveband': []
+                })
+
+        return records
+
+    @staticmethod
+    def dump_registry(dump_file, service_type='TAP'):
+        parameters = RegistrySearchParameters(
+            service_type=service_type).get_parameters()
+
+        records = Registry._search_registry_records(parameters)
+
+        for record in records:
+            record['service_type'] = parameters['service_type']
+
+        with open(dump_file, 'w') as dump:
+            json.dump(records, dump, default=str)
+
+        return len(records)
+
+    schema = """
+        CREATE TABLE services (
+            access_url TEXT PRIMARY KEY,
+            position INTEGER,
+            standard_id TEXT,
+            res_title TEXT,
+            short_name TEXT,
+            service_type TEXT,
+            search_text TEXT
+        );
+        CREATE TABLE wavebands (
+            access_url TEXT,
+            waveband TEXT
+        );
+        CREATE INDEX services_service_type ON services (service_type);
+        CREATE INDEX wavebands_waveband ON wavebands (waveband);
+    """
+
+
+class TapQuery:
+
+    def __init__(self, query):
+        self.raw_query = query
+
+    def get_query(self):
+        return urllib.parse.unquote(self.raw_query).replace("+", " ")
+
+
+class BaseADQLQuery:
+
+    def __init__(self):
+        pass
+
+    def _get_order_by_clause(self, order_type):
+        order_by_clause = 'ORDER BY ' + order_type
 
         return order_by_clause
 
-    def _get_where_clause(self, parameters):
-        where_clause = ''
-        is_first_statement = True
+    def _get_where_clause(self, parameters):
+        where_clause = ''
+        is_first_statement = True
+
+        for key, value in parameters.items():
+
+            if value != '':
+                statement = str(key) + ' = ' + '\'' + str(value) + '\' '
+
+                if is_first_statement:
+                    is_first_statement = False
+                    where_clause += 'WHERE '
+                else:
+                    statement = 'AND ' + statement
+
+                where_clause += statement
+
+        return where_clause
+
+
+class ToolRunner:
+
+    def __init__(self,
+                 run_parameters,
+                 output,
+                 output_csv,
+                 output_html,
+                 output_basic_html,
+                 output_error,
+                 output_table=None,
+                 output_trace=None,
+                 init_workers=MAX_INIT_WORKERS,
+                 init_timeout=ARCHIVE_INIT_TIMEOUT,
+                 query_timeout=ARCHIVE_QUERY_TIMEOUT,
+                 refresh_cache=False):
+
+        self._raw_parameters_path = run_parameters
+        self._json_parameters = json.load(open(run_parameters, "r"))
+        self._archive_type = ''
+        self._query_type = ''
+        self._query_mode = TAP_QUERY_MODE
+        self._archives = []
+        self._adql_query = ''
+        self._target_queries = []
+        self._is_batch_query = False
+        self._services_access_url = ''
+        self._url_field = 'access_url'
+        self._order_by_field = None
+        self._number_of_files = ''
+        self._query_fields = None
+        self._is_initialised = False
+        self._init_workers = init_workers
+        self._init_timeout = init_timeout
+        self._query_timeout = query_timeout
+        self._refresh_cache = refresh_cache
+
+        self._csv_file = False
+        self._image_file = False
+        self._html_file = False
+        self._basic_html_file = False
+        self._table_file = False
+        self._table_format = 'csv'
+
+        self._output = output
+        self._output_csv = output_csv
+        self._output_html = output_html
+        self._output_basic_html = output_basic_html
+        self._output_error = output_error
+        self._output_table = output_table
+        self._output_trace = output_trace
+
+        self._set_run_main_parameters()
+
+        self._is_initialised, error_message = self._set_archive()
+
+        if self._is_initialised and error_message is None:
+            self._set_output()
+            self._set_query()
+
+    def _set_run_main_parameters(self):
+
+        qs = "query_section"
+        qsl = "query_selection"
+
+        self._archive_type = \
+            self._json_parameters['archive_selection']['archive_type']
+        self._query_type = \
+            self._json_parameters[qs][qsl]['query_type']
+        self._query_mode = \
+            self._json_parameters[qs].get('query_mode', TAP_QUERY_MODE)
+
+        self._set_advanced_parameters()
+
+    def _set_advanced_parameters(self):
+        advanced_section = \
+            self._json_parameters.get('advanced_section') or {}
+
+        self._init_workers = ToolRunner._get_positive_integer(
+            advanced_section.get('init_workers'), self._init_workers)
+        self._init_timeout = ToolRunner._get_positive_integer(
+            advanced_section.get('init_timeout'), self._init_timeout)
+        self._query_timeout = ToolRunner._get_positive_integer(
+            advanced_section.get('query_timeout'), self._query_timeout)
+
+        if advanced_section.get('refresh_cache'):
+            self._refresh_cache = True
+
+        # the trace output only exists when it was asked for
+        if advanced_section.get('trace') and self._output_trace:
+            Tracer.reset(True)
+        else:
+            self._output_trace = None
+
+    @staticmethod
+    def _get_positive_integer(value, default):
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            return default
+
+        return value if value >= 1 else default
+
+    def _set_archive(self):
+
+        error_message = None
+
+        if self._archive_type == 'archive':
+            self._service_access_url =\
+                self._json_parameters['archive_selection']['archive']
+
+            self._archives.append(
+                TapArchive(access_url=self._service_access_url))
+
+        else:
+            keyword = \
+                self._json_parameters['archive_selection']['keyword']
+            waveband = \
+                self._json_parameters['archive_selection']['wavebands']
+            service_type = \
+                self._json_parameters['archive_selection']['service_type']
+
+            rsp = RegistrySearchParameters(
+                keyword=keyword,
+                waveband=waveband,
+                service_type=service_type)
+
+            archive_list = Registry.search_registries(
+                rsp,
+                MAX_REGISTRIES_TO_SEARCH)
+
+            if len(archive_list) >= 1:
+                self._archives = ArchiveHealth.select(
+                    archive_list,
+                    needs_obscore=self._query_type != 'raw_query')
+            else:
+                error_message = "no archive matching search parameters"
+                Logger.create_action_log(
+                    Logger.ACTION_ERROR,
+                    Logger.ACTION_TYPE_ARCHIVE_CONNECTION,
+                    error_message)
+
+        if error_message is None:
+
+            for archive in self._archives:
+                archive.init_timeout = self._init_timeout
+                archive.query_timeout = self._query_timeout
+
+            self._archives[:] = self._initialize_archives()
+
+            if len(self._archives) >= 1:
+                return True, None
+            else:
+                return False, \
+                    "no archive matching search" \
+                    " parameters could be initialized"
+
+        else:
+            return False, error_message
+
+    def _initialize_archives(self):
+
+        initialized_archives = []
+
+        task_pool = TaskPool(self._init_workers, self._init_timeout)
+
+        for archive, result, exception in task_pool.map(
+                self._initialize_archive,
+                self._archives):
+
+            if exception is None:
+                if result[0]:
+                    initialized_archives.append(archive)
+                else:
+                    ArchiveHealth.record_failure(archive.access_url)
+            else:
+                ArchiveHealth.record_failure(
+                    archive.access_url,
+                    isinstance(exception, TimeoutException))
+
+                if isinstance(exception, TimeoutException):
+                    error_message = "initialization timeout for "
+                else:
+                    error_message = "Unknown error while initializing "
+
+                error_message += archive.get_archive_name(self._archive_type)
+
+                Logger.create_action_log(
+                    Logger.ACTION_ERROR,
+                    Logger.ACTION_TYPE_ARCHIVE_CONNECTION,
+                    error_message)
+
+        return initialized_archives
+
+    def _initialize_archive(self, archive):
+        start = time.monotonic()
+
+        result = archive.initialize(self._refresh_cache)
+
+        if result[0]:
+            ArchiveHealth.record_success(archive.access_url,
+                                         'init',
+                                         time.monotonic() - start)
+
+        return result
+
+    def _set_cone_service(self):
+
+        qs = 'query_section'
+        qsl = 'query_selection'
+        csts = 'cone_search_target_selection'
+
+        error_message = None
+        is_service_initialised = True
+
+        keyword = self._json_parameters[qs][qsl][csts]['keyword']
+
+        service_list = ConeServiceRegistry.search_services(
+            keyword,
+            MAX_REGISTRIES_TO_SEARCH)
+
+        if len(service_list) >= 1:
+            self._services = service_list
+        else:
+            is_service_initialised = False
+            error_message = "no services matching search parameters"
+            Logger.create_action_log(
+                Logger.ACTION_ERROR,
+                Logger.ACTION_TYPE_ARCHIVE_CONNECTION,
+                error_message)
+
+        return is_service_initialised, error_message
+
+    def _set_query(self):
+
+        qs = 'query_section'
+        qsl = 'query_selection'
+        csts = 'cone_search_target_selection'
+        cs = 'cone_section'
+        ts = 'target_selection'
+        con = 'cone_object_name'
+
+        if self._query_type == 'obscore_query':
+
+            dataproduct_type = \
+                self._json_parameters[qs][qsl]['dataproduct_type']
+            obs_collection = \
+                self._json_parameters[qs][qsl]['obs_collection']
+            obs_title = \
+                self._json_parameters[qs][qsl]['obs_title']
+            obs_id = \
+                self._json_parameters[qs][qsl]['obs_id']
+            facility_name = \
+                self._json_parameters[qs][qsl]['facility_name']
+            instrument_name = \
+                self._json_parameters[qs][qsl]['instrument_name']
+            em_min = \
+                self._json_parameters[qs][qsl]['em_min']
+            em_max = \
+                self._json_parameters[qs][qsl]['em_max']
+            target_name = \
+                self._json_parameters[qs][qsl]['target_name']
+            obs_publisher_id = \
+                self._json_parameters[qs][qsl]['obs_publisher_id']
+            s_fov = \
+                self._json_parameters[qs][qsl]['s_fov']
+            calibration_level = \
+                self._json_parameters[qs][qsl]['calibration_level']
+            t_min = \
+                self._json_parameters[qs][qsl]['t_min']
+            t_max = \
+                self._json_parameters[qs][qsl]['t_max']
+            order_by = \
+                self._json_parameters[qs][qsl]['order_by']
+
+            self._order_by_field = \
+                ADQLObscoreQuery.order_by_field.get(order_by)
+
+            radius = self._json_parameters[qs][qsl][cs]['radius']
+
+            if self._json_parameters[qs][qsl][cs][csts][ts] == 'coordinates':
+                ra = self._json_parameters[qs][qsl][cs][csts]['ra']
+                dec = self._json_parameters[qs][qsl][cs][csts]['dec']
+            elif self._json_parameters[qs][qsl][cs][csts][ts] == \
+                    'target_table':
+                ra = None
+                dec = None
+
+                targets = TargetTable.read(
+                    self._json_parameters[qs][qsl][cs][csts]['target_table'],
+                    radius)
+            else:
+                obs_target = self._json_parameters[qs][qsl][cs][csts][con]
+
+                if obs_target != 'none' and obs_target is not None:
+                    target = CelestialObject(obs_target)
+                    target_coordinates = target.get_coordinates_in_degrees()
+
+                    ra = target_coordinates['ra']
+                    dec = target_coordinates['dec']
+                else:
+                    ra = None
+                    dec = None
+
+            if (ra != '' and ra is not None)\
+                    and (dec != '' and dec is not None)\
+                    and (radius != '' and radius is not None):
+                cone_condition = \
+                    ADQLConeSearchQuery.get_search_circle_condition(ra,
+                                                                    dec,
+                                                                    radius)
+            else:
+                cone_condition = None
+
+            def get_obscore_query(cone_condition):
+                return ADQLObscoreQuery(dataproduct_type,
+                                        obs_collection,
+                                        obs_title,
+                                        obs_id,
+                                        facility_name,
+                                        instrument_name,
+                                        em_min,
+                                        em_max,
+                                        target_name,
+                                        obs_publisher_id,
+                                        s_fov,
+                                        calibration_level,
+                                        t_min,
+                                        t_max,
+                                        cone_condition,
+                                        order_by,
+                                        self._number_of_files,
+                                        self._query_fields).get_query()
+
+            if self._json_parameters[qs][qsl][cs][csts][ts] == \
+                    'target_table':
+                self._is_batch_query = True
+                self._target_queries = [
+                    (target['label'],
+                     get_obscore_query(
+                         ADQLConeSearchQuery.get_search_circle_condition(
+                             target['ra'],
+                             target['dec'],
+                             target['radius'])))
+                    for target in targets
+                    if target['ra'] is not None and
+                    target['dec'] is not None and
+                    target['radius'] not in ['', None]]
+
+                self._adql_query = get_obscore_query(None) + \
+                    ' (cone search on ' + \
+                    str(len(self._target_queries)) + ' targets)'
+            else:
+                self._adql_query = get_obscore_query(cone_condition)
+
+        elif self._query_type == 'raw_query':
+
+            wc = 'where_clause'
+
+            tap_table = \
+                self._json_parameters[qs][qsl]['table']
+
+            where_field = \
+                self._json_parameters[qs][qsl][wc]['where_field']
+            where_condition = \
+                self._json_parameters[qs][qsl][wc]['where_condition']
+
+            self._url_field = \
+                self._json_parameters[qs][qsl]['url_field']
+
+            self._adql_query = \
+                ADQLTapQuery(self._number_of_files).get_query(
+                    tap_table,
+                    where_field,
+                    where_condition)
+        else:
+            self._adql_query = ADQLObscoreQuery.get_base_query(
+                self._number_of_files,
+                self._query_fields)
+
+    def _set_cone_query(self):
+
+        qs = 'query_section'
+        qsl = 'query_selection'
+        csts = 'cone_search_target_selection'
+        ts = 'target_selection'
+        con = 'cone_object_name'
+
+        search_radius = self._json_parameters[qs][qsl]['radius']
+        time = None
+
+        if self._json_parameters[qs][qsl][csts][ts] == 'coordinates':
+            ra = self._json_parameters[qs][qsl][csts]['ra']
+            dec = self._json_parameters[qs][qsl][csts]['dec']
+            time = self._json_parameters[qs][qsl][csts]['time']
+        else:
+            target = CelestialObject(self._json_parameters[qs][qsl][csts][con])
+
+            target_coordinates = target.get_coordinates_in_degrees()
+
+            ra = target_coordinates['ra']
+            dec = target_coordinates['dec']
+
+        cone_query_object = ADQLConeSearchQuery(ra,
+                                                dec,
+                                                search_radius,
+                                                time,
+                                                self._number_of_files,
+                                                self._query_fields)
+
+        self._adql_query = cone_query_object.get_query()
+
+    def _set_output(self):
+        self._number_of_files = \
+            int(
+                self._json_parameters['output_section']['number_of_files']
+            )
+
+        if self._number_of_files < 1:
+            self._number_of_files = 1
+        elif self._number_of_files > 100:
+            self._number_of_files = MAX_ALLOWED_ENTRIES
+
+        output_selection = \
+            self._json_parameters['output_section']['output_selection']
+
+        if output_selection is not None:
+            if 'c' in output_selection:
+                self._csv_file = True
+            if 'i' in output_selection:
+                self._image_file = True
+            if 'h' in output_selection:
+                self._html_file = True
+            if 'b' in output_selection:
+                self._basic_html_file = True
+            if 't' in output_selection and self._output_table:
+                self._table_file = True
+
+        self._table_format = \
+            self._json_parameters['output_section'].get('table_format',
+                                                        'csv')
+
+        if self._table_format not in EXPORT_FORMATS:
+            self._table_format = 'csv'
+
+        # Reports and table exports show every column, other outputs only
+        # need the urls
+        if self._html_file or self._basic_html_file or self._table_file:
+            self._query_fields = None
+        else:
+            self._query_fields = ADQLObscoreQuery.projected_fields
+
+    def _validate_json_parameters(self, json_parameters):
+        self._json_parameters = json.load(open(json_parameters, "r"))
+
+    def _query_archives(self, query):
+        error_message = None
+        resource_merger = ResourceMerger(self._url_field,
+                                         self._order_by_field)
+
+        if self._query_mode == 'async':
+            results, delete_jobs = self._get_job_results(query)
+        else:
+            task_pool = TaskPool(MAX_QUERY_WORKERS, self._query_timeout)
+            delete_jobs = None
+
+            results = task_pool.map(
+                lambda archive: self._get_archive_resources(archive, query),
+                self._archives)
+
+        try:
+            for archive, result, exception in results:
+                if exception is None:
+                    resource_table, error_message = result
+                    resource_merger.add(resource_table)
+                elif isinstance(exception, TimeoutException):
+                    ArchiveHealth.record_failure(archive.access_url, True)
+
+                    error_message = \
+                        "Archive is taking too long to respond (timeout)"
+                    Logger.create_action_log(
+                        Logger.ACTION_ERROR,
+                        Logger.ACTION_TYPE_QUERY,
+                        error_message)
+                else:
+                    ArchiveHealth.record_failure(archive.access_url)
+                    error_message = "Unknown error while querying the service"
+                    Logger.create_action_log(
+                        Logger.ACTION_ERROR,
+                        Logger.ACTION_TYPE_QUERY,
+                        error_message)
+
+                # ordered results need every archive before picking the
+                # first ones
+                if self._order_by_field is None and \
+                        len(resource_merger) >= int(self._number_of_files):
+                    break
+        finally:
+            results.close()
+
+            if delete_jobs is not None:
+                delete_jobs()
+
+        resource_table = \
+            resource_merger.get_table(int(self._number_of_files))
+
+        return resource_table, error_message
+
+    def _get_archive_resources(self, archive, query, job=None):
+        # the archive records its health from the outcome of the query
+        if job is None:
+            return archive.get_resources(query,
+                                         self._number_of_files,
+                                         self._url_field)
+
+        return archive.get_job_resources(job,
+                                         query,
+                                         self._number_of_files)
+
+    def _get_job_results(self, query):
+        """
+        Submit the query as a job on every archive and read the results
+        like _get_archive_resources, the returned function deletes the
+        jobs not read yet
+        """
+
+        jobs = {}
+        jobs_lock = threading.Lock()
+
+        submit_pool = TaskPool(MAX_QUERY_WORKERS, self._query_timeout)
+
+        submitted = submit_pool.map(
+            lambda archive: archive.submit_job(query,
+                                               self._number_of_files),
+            [archive for archive in self._archives if archive.initialized])
+
+        for archive, job, exception in submitted:
+            if exception is None:
+                jobs[archive] = job
+
+        submitted_archives = set(jobs)
+
+        def get_resources(archive):
+            with jobs_lock:
+                job = jobs.pop(archive, None)
+
+            if job is None:
+                if archive in submitted_archives:
+                    # the job was deleted when the results were closed
+                    return ResourceTable(), None
+
+                return self._get_archive_resources(archive, query)
+
+            try:
+                return self._get_archive_resources(archive, query, job)
+            finally:
+                TapArchive.delete_job(job)
+
+        def delete_jobs():
+            with jobs_lock:
+                remaining_jobs = list(jobs.values())
+                jobs.clear()
+
+            for job in remaining_jobs:
+                TapArchive.delete_job(job)
+
+        task_pool = TaskPool(MAX_QUERY_WORKERS, ARCHIVE_ASYNC_QUERY_TIMEOUT)
+
+        return task_pool.map(get_resources, self._archives), delete_jobs
+
+    def _query_targets(self):
+        """
+        Run the query of every target of a batch on the archives already
+        initialized, the results are tagged with their target. A batch
+        returns at most MAX_BATCH_ENTRIES rows, the targets not queried
+        yet are skipped once it is reached
+        """
+        error_message = None
+        resource_tables = []
+        number_of_rows = 0
+
+        task_pool = TaskPool(MAX_TARGET_WORKERS)
+
+        results = task_pool.map(
+            lambda target_query: self._query_archives(target_query[1]),
+            self._target_queries)
+
+        try:
+            for (label, query), result, exception in results:
+                if exception is not None:
+                    error_message = "Unknown error while querying the service"
+                    continue
+
+                resource_table, _error_message = result
+
+                if _error_message is not None:
+                    error_message = _error_message
+
+                resource_tables.append(
+                    ResourceTable(['target'] + resource_table.keys,
+                                  [[label] * len(resource_table)] +
+                                  resource_table.columns))
+
+                number_of_rows += len(resource_table)
+
+                if number_of_rows >= MAX_BATCH_ENTRIES:
+                    Logger.create_action_log(
+                        Logger.ACTION_ERROR,
+                        Logger.ACTION_TYPE_QUERY,
+                        "batch results limited to " +
+                        str(MAX_BATCH_ENTRIES) + " rows")
+                    break
+        finally:
+            results.close()
+
+        resource_table = ResourceTable.concatenate(resource_tables)
+
+        return resource_table.head(MAX_BATCH_ENTRIES), error_message
+
+    def _download_files(self, resource_table):
+        """
+        Download the file of every row, once per url. The rows of a
+        batch can share urls when the cones of their targets overlap,
+        at most MAX_ALLOWED_ENTRIES files are downloaded
+        """
+        downloads = []
+
+        url_index = resource_table.get_column_index(self._url_field)
+
+        if url_index is None:
+            urls = [None] * len(resource_table)
+        else:
+            urls = resource_table.get_column(url_index)
+
+        seen_urls = set()
+        paths = set()
+
+        for url in urls:
+            if len(downloads) >= MAX_ALLOWED_ENTRIES:
+                break
+
+            if url is ResourceTable.MISSING:
+                url = None
+
+            # rows without url are still reported as failed downloads
+            if url is not None:
+                if url in seen_urls:
+                    continue
+
+                seen_urls.add(url)
+
+            if not downloads:
+                path = self._output
+            else:
+                file_name = FileHandler.get_file_name_from_url(str(url))
+                path = FileHandler.get_subdir_path(file_name)
+
+                # different urls can end with the same file name
+                if path in paths:
+                    path = FileHandler.get_subdir_path(
+                        file_name + '_' + str(len(downloads)))
+
+            paths.add(path)
+            downloads.append((url, path))
+
+        downloader = Downloader(cache=DownloadCache.get_cache())
+
+        for url, path, exception in downloader.download(downloads):
+            if exception is None:
+                Logger.create_action_log(
+                    Logger.ACTION_SUCCESS,
+                    Logger.ACTION_TYPE_DOWNLOAD,
+                    "from url " + url)
+            else:
+                Logger.create_action_log(
+                    Logger.ACTION_ERROR,
+                    Logger.ACTION_TYPE_DOWNLOAD,
+                    "from url " + str(url))
+
+    def _write_table(self, resource_table):
+        try:
+            TableExporter.write_table(resource_table,
+                                      self._output_table,
+                                      self._table_format)
+        except Exception as e:
+            Logger.create_action_log(
+                Logger.ACTION_ERROR,
+                Logger.ACTION_TYPE_WRITE_FILE,
+                f"{self._table_format} table export failed ({e})")
+
+    def run(self):
+        try:
+            with Tracer.span('run'):
+                self._run()
+        finally:
+            ArchiveHealth.flush()
+
+        Tracer.write_trace(
+            self._output_trace or
+            os.path.join(FileHandler.get_working_directory(), TRACE_FILE))
+
+    def _run(self):
+        if self._is_initialised:
+            archive_name = self._archives[0].get_archive_name(
+                self._archive_type)
+
+            if self._is_batch_query:
+                resource_table, error_message = self._query_targets()
+            else:
+                resource_table, error_message = \
+                    self._query_archives(self._adql_query)
+
+            if len(resource_table):
+
+                rows = len(resource_table)
+
+                if self._csv_file:
+                    with Tracer.span('output.csv', rows=rows):
+                        FileHandler.write_urls_to_output(
+                            resource_table,
+                            self._output_csv,
+                            self._url_field)
+
+                if self._image_file:
+                    with Tracer.span('output.downloads', rows=rows):
+                        self._download_files(resource_table)
+
+                if self._table_file:
+                    with Tracer.span('output.table',
+                                     rows=rows,
+                                     format=self._table_format):
+                        self._write_table(resource_table)
+
+                if self._html_file:
+                    with Tracer.span('output.html', rows=rows):
+                        OutputHandler.write_html_output(resource_table,
+                                                        archive_name,
+                                                        self._adql_query,
+                                                        self._output_html)
+
+                if self._basic_html_file:
+                    with Tracer.span('output.basic_html', rows=rows):
+                        OutputHandler.write_basic_html_output(
+                            resource_table,
+                            archive_name,
+                            self._adql_query,
+                            self._output_basic_html)
+
+                summary_file = Logger.create_log_file(archive_name,
+                                                      self._adql_query)
+                summary_file += "\n Tool run executed with success"
+
+                FileHandler.write_file_to_output(summary_file,
+                                                 self._output_error)
+
+            else:
+
+                summary_file = Logger.create_log_file(archive_name,
+                                                      self._adql_query)
+
+                if error_message is None:
+                    summary_file += \
+                        "\n No resources matching parameters found"
+                else:
+                    summary_file += error_message
+
+                FileHandler.write_file_to_output(summary_file,
+                                                 self._output_error)
+        else:
+            summary_file = Logger.create_log_file("Archive",
+                                                  self._adql_query)
+
+            summary_file += "Unable to initialize archives"
+
+            FileHandler.write_file_to_output(summary_file,
+                                             self._output_error)
+
+
+class ADQLObscoreQuery(BaseADQLQuery):
+    order_by_field = {
+        'size': 'access_estsize',
+        'collection': 'obs_collection',
+        'object': 'target_name'
+    }
+
+    projected_fields = [
+        'obs_publisher_id',
+        'obs_collection',
+        'obs_id',
+        'target_name',
+        'dataproduct_type',
+        'access_url',
+        'access_format',
+        'access_estsize'
+    ]
+
+    def __init__(self,
+                 dataproduct_type,
+                 obs_collection,
+                 obs_title,
+                 obs_id,
+                 facility_name,
+                 instrument_name,
+                 em_min,
+                 em_max,
+                 target_name,
+                 obs_publisher_id,
+                 s_fov,
+                 calibration_level,
+                 t_min,
+                 t_max,
+                 cone_condition,
+                 order_by,
+                 number_of_results=MAX_ALLOWED_ENTRIES,
+                 fields=None):
+
+        super().__init__()
+
+        if calibration_level == 'none':
+            calibration_level = ''
+
+        if order_by == 'none':
+            order_by = ''
+
+        if t_min == 'None' or t_min is None:
+            t_min = ''
+
+        if t_max == 'None' or t_max is None:
+            t_max = ''
+
+        if em_min == 'None' or em_min is None:
+            em_min = ''
+
+        if em_max == 'None' or em_max is None:
+            em_max = ''
+
+        if dataproduct_type == 'none' or dataproduct_type is None:
+            dataproduct_type = ''
+
+        if cone_condition is not None:
+            self.cone_condition = cone_condition
+        else:
+            self.cone_condition = None
+
+        self.parameters = {
+            'dataproduct_type': dataproduct_type,
+            'obs_collection': obs_collection,
+            'obs_title': obs_title,
+            'obs_id': obs_id,
+            'facility_name': facility_name,
+            'instrument_name': instrument_name,
+            'em_min': em_min,
+            'em_max': em_max,
+            'target_name': target_name,
+            'obs_publisher_id': obs_publisher_id,
+            's_fov': s_fov,
+            'calib_level': calibration_level,
+            't_min': t_min,
+            't_max': t_max,
+        }
+
+        self.order_by = order_by
+        self.number_of_results = number_of_results
+        self.fields = fields
+
+    def get_query(self):
+        return ADQLObscoreQuery.get_base_query(self.number_of_results,
+                                               self.fields) + \
+            self.get_where_statement() + \
+            self.get_order_by_statement()
+
+    @staticmethod
+    def get_base_query(number_of_results=MAX_ALLOWED_ENTRIES, fields=None):
+        if fields:
+            select_list = ', '.join(fields)
+        else:
+            select_list = '*'
+
+        return 'SELECT TOP ' + str(number_of_results) + ' ' + \
+            select_list + ' FROM ivoa.obscore '
+
+    def get_order_by_statement(self):
+        if self.order_by != '':
+            return self._get_order_by_clause(self.order_by)
+        else:
+            return ''
+
+    def _get_order_by_clause(self, order_type):
+
+        obscore_order_type = ADQLObscoreQuery.order_by_field[order_type]
+
+        return super()._get_order_by_clause(obscore_order_type)
+
+    def get_where_statement(self):
+        where_clause = self._get_where_clause(self.parameters)
+
+        if where_clause == '' and self.cone_condition is not None:
+            where_clause = 'WHERE ' + self.get_cone_condition()
+        elif where_clause != '' and self.cone_condition is not None:
+            where_clause += 'AND ' + self.get_cone_condition()
+
+        return where_clause
+
+    def _get_where_clause(self, parameters):
+        return super()._get_where_clause(parameters)
+
+    def get_cone_condition(self):
+        return self.cone_condition
+
+
+class ADQLTapQuery(BaseADQLQuery):
+
+    def __init__(self, number_of_results=MAX_ALLOWED_ENTRIES):
+        super().__init__()
+
+        self.base_query = 'SELECT TOP ' + str(number_of_results) + ' * FROM '
+
+    def get_order_by_clause(self, order_type):
+        return super()._get_order_by_clause(order_type)
+
+    def get_query(self, table, where_field, where_condition):
+        if where_field != '' and where_condition != '':
+            return self.base_query + \
+                str(table) + \
+                ' WHERE ' + \
+                str(where_field) + ' = ' + '\'' + \
+                str(where_condition) + '\''
+        else:
+            return self.base_query + str(table)
+
+
+class ADQLConeSearchQuery:
+
+    def __init__(self,
+                 ra,
+                 dec,
+                 radius,
+                 time=None,
+                 number_of_results=MAX_ALLOWED_ENTRIES,
+                 fields=None):
+
+        self.ra = ra
+        self.dec = dec
+        self.radius = radius
+        self.time = time
+
+        self._query = ADQLObscoreQuery.get_base_query(number_of_results,
+                                                      fields)
+
+        if self.ra and self.dec and self.radius:
+            self._query += " WHERE "
+            self._query += self._get_search_circle(ra, dec, radius)
+
+            if self.time:
+                self._query += self._get_search_time()
+
+    def _get_search_circle(self, ra, dec, radius):
+        return "(CONTAINS" \
+               "(POINT('ICRS', s_ra, s_dec), " \
+               "CIRCLE('ICRS', "+str(ra)+", "+str(dec)+", "+str(radius)+")" \
+               ") = 1)"
+
+    def _get_search_time(self):
+        return " AND t_min <= "+self.time+" AND t_max >= "+self.time
+
+    def get_query(self):
+        return self._query
+
+    @staticmethod
+    def get_search_circle_condition(ra, dec, radius):
+        return "(CONTAINS" \
+               "(POINT('ICRS', s_ra, s_dec)," \
+               "CIRCLE('ICRS', "+str(ra)+", "+str(dec)+", "+str(radius)+")" \
+               ") = 1) "
+
+
+class CelestialObject:
+    resolver_cache = FileCache('names',
+                               NAME_RESOLVER_CACHE_TTL,
+                               NAME_RESOLVER_CACHE_MAX_ENTRIES)
+
+    preload_path = NAME_RESOLVER_PRELOAD
+    _preloaded_targets = None
+
+    def __init__(self, name, coordinates=None):
+        self.name = name
+        self.coordinates = None
+
+        if coordinates is None:
+            coordinates = CelestialObject.resolve(self.name)
+
+        self.coordinates = coordinates
+
+    @staticmethod
+    def resolve(name):
+        """
+        Coordinates of an object name, from the preloaded targets or the
+        resolver cache before asking Sesame
+        """
+        coordinates = CelestialObject._get_known_coordinates(name)
+
+        if coordinates is None:
+            coordinates = astropy_coordinates.SkyCoord.from_name(name)
+
+            CelestialObject.resolver_cache.set(
+                CelestialObject.normalize_name(name),
+                {'ra': coordinates.ra.degree, 'dec': coordinates.dec.degree})
+
+        return coordinates
+
+    @staticmethod
+    def resolve_names(names, max_workers=MAX_RESOLVER_WORKERS):
+        """
+        Resolve many names at once, only the unknown ones are sent to
+        Sesame, concurrently. Returns a dict of name -> coordinates or
+        the exception raised while resolving it
+        """
+        resolved = {}
+        unknown = []
+
+        for name in dict.fromkeys(names):
+            coordinates = CelestialObject._get_known_coordinates(name)
+
+            if coordinates is None:
+                unknown.append(name)
+            else:
+                resolved[name] = coordinates
+
+        task_pool = TaskPool(max_workers, NAME_RESOLVER_TIMEOUT)
+
+        for name, coordinates, exception in \
+                task_pool.map(CelestialObject.resolve, unknown):
+            resolved[name] = coordinates if exception is None else exception
+
+        return resolved
+
+    @staticmethod
+    def normalize_name(name):
+        return ' '.join(str(name).lower().split())
+
+    @staticmethod
+    def get_preloaded_targets():
+        if CelestialObject._preloaded_targets is None:
+            preloaded_targets = {}
+
+            if CelestialObject.preload_path:
+                try:
+                    with open(CelestialObject.preload_path, 'r') as targets:
+                        for name, value in json.load(targets).items():
+                            preloaded_targets[
+                                CelestialObject.normalize_name(name)] = value
+                except (OSError, ValueError, AttributeError):
+                    pass
+
+            CelestialObject._preloaded_targets = preloaded_targets
+
+        return CelestialObject._preloaded_targets
+
+    @staticmethod
+    def _get_known_coordinates(name):
+        key = CelestialObject.normalize_name(name)
+
+        value = CelestialObject.get_preloaded_targets().get(key)
+
+        if value is None:
+            value = CelestialObject.resolver_cache.get(key)
+
+        try:
+            return astropy_coordinates.SkyCoord(ra=float(value['ra']),
+                                                dec=float(value['dec']),
+                                                unit='deg')
+        except (TypeError, KeyError, ValueError):
+            return None
+
+    def get_coordinates_in_degrees(self):
+
+        coordinates = {
+            'ra': '',
+            'dec': ''
+        }
+
+        ra_dec = self.coordinates.ravel()
+
+        coordinates['ra'] = ra_dec.ra.degree[0]
+        coordinates['dec'] = ra_dec.dec.degree[0]
+
+        return coordinates
+
+
+class TargetTable:
+    """
+    Targets of a batch cone search, one per line: a source name or
+    ra,dec in degree, optionally followed by a search radius in degree
+    """
+
+    header_fields = ['name', 'target', 'ra', 'dec', 'radius']
+
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def read(path, radius, max_targets=MAX_BATCH_TARGETS):
+        targets = []
+
+        with open(path, 'r') as target_file:
+            for line in target_file:
+                fields = [field.strip()
+                          for field in re.split(r'[,\t]', line.strip())]
+
+                if not fields[0] or fields[0].startswith('#'):
+                    continue
+
+                if all(field.lower() in TargetTable.header_fields
+                       for field in fields if field):
+                    continue
+
+                targets.append(TargetTable._get_target(fields, radius))
+
+                if len(targets) >= max_targets:
+                    break
+
+        TargetTable._resolve_names(targets)
+
+        return targets
+
+    @staticmethod
+    def _get_target(fields, radius):
+        target = {'name': None, 'ra': None, 'dec': None, 'radius': radius}
+
+        if len(fields) > 1 and TargetTable._is_number(fields[0]) and \
+                TargetTable._is_number(fields[1]):
+            target['ra'] = float(fields[0])
+            target['dec'] = float(fields[1])
+            target['label'] = fields[0] + ' ' + fields[1]
+            extra = fields[2:]
+        else:
+            target['name'] = fields[0]
+            target['label'] = fields[0]
+            extra = fields[1:]
+
+        if extra and TargetTable._is_number(extra[0]):
+            target['radius'] = float(extra[0])
+
+        return target
+
+    @staticmethod
+    def _resolve_names(targets):
+        resolved = CelestialObject.resolve_names(
+            [target['name'] for target in targets if target['name']])
+
+        for target in targets:
+            coordinates = resolved.get(target['name'])
+
+            if target['name'] is None:
+                continue
+            elif isinstance(coordinates, Exception) or coordinates is None:
+                Logger.create_action_log(
+                    Logger.ACTION_ERROR,
+                    Logger.ACTION_TYPE_ARCHIVE_CONNECTION,
+                    "unable to resolve target " + target['name'])
+            else:
+                target['ra'] = coordinates.ra.degree
+                target['dec'] = coordinates.dec.degree
+
+    @staticmethod
+    def _is_number(value):
+        try:
+            float(value)
+            return True
+        except ValueError:
+            return False
+
+
+class HTMLReport:
+    _html_report_base_header = ''
+    _html_report_base_body = ''
+    _html_report_base_footer = ''
+    _html_report_base_script = ''
+
+    def __init__(self):
+        pass
+
+
+class OutputHandler:
+
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def generate_html_output(urls_data, archive_name, adql_query):
+        html_file = io.StringIO()
+
+        OutputHandler.write_html_output(
+            ResourceTable.from_resources(urls_data),
+            archive_name,
+            adql_query,
+            html_file)
+
+        return html_file.getvalue()
+
+    @staticmethod
+    def generate_basic_html_output(urls_data,
+                                   archive_name,
+                                   adql_query, ):
+        html_file = io.StringIO()
+
+        OutputHandler.write_basic_html_output(
+            ResourceTable.from_resources(urls_data),
+            archive_name,
+            adql_query,
+            html_file)
+
+        return html_file.getvalue()
+
+    @staticmethod
+    def write_html_output(resource_table, archive_name, adql_query, output):
+        with FileHandler.open_output(output) as file_output:
+            file_output.write(OutputHandler.html_header)
+
+            OutputHandler.write_html_content(
+                file_output,
+                resource_table,
+                archive_name,
+                adql_query,
+                div_attr='class="title"',
+                table_attr='class="fl-table"')
+
+    @staticmethod
+    def write_basic_html_output(resource_table,
+                                archive_name,
+                                adql_query,
+                                output):
+        with FileHandler.open_output(output) as file_output:
+            OutputHandler.write_html_content(file_output,
+                                             resource_table,
+                                             archive_name,
+                                             adql_query)
+
+    @staticmethod
+    def write_html_content(file_output,
+                           resource_table,
+                           archive_name,
+                           adql_query,
+                           div_attr="",
+                           table_attr="border='1'"):
+        """
+        Write the resources table row by row, without building the
+        whole report in memory
+        """
+
+        file_output.write(
+            f"""
+                    <div {div_attr}>
+                        <h2>Resources Preview archive:
+                            <span>
+                                {archive_name}
+                            </span>
+                        </h2>
+                        <span>ADQL query : {adql_query}</span>
+                    </div>""")
+
+        file_output.write(f'<table {table_attr}><thead><tr>')
+
+        file_output.write(
+            ''.join('<th>' + str(key) + '</th>'
+                    for key in resource_table.keys))
+
+        file_output.write('<th></th></tr></thead><tbody>')
+
+        preview_index = [
+            resource_table.get_column_index(preview_key)
+            for preview_key in ['preview', 'preview_url', 'postcard_url']
+            if resource_table.get_column_index(preview_key) is not None]
+
+        for row in resource_table.get_rows():
+            file_output.write(OutputHandler._get_html_row(row,
+                                                          preview_index))
+
+        file_output.write('</tbody></table>')
+
+    @staticmethod
+    def _get_html_row(row, preview_index):
+        html_row = ['<tr>']
+
+        for value in row:
+            html_row.append(f'<td>{value}</td>')
+
+        html_row.append('<td>')
+        for index in preview_index:
+            if row[index] is not ResourceTable.MISSING:
+                html_row.append(
+                    '<details><summary>Preview</summary>'
+                    f'<img src="{row[index]}"/>'
+                    '</details>'
+                )
+        html_row.append('</td></tr>')
+
+        return ''.join(html_row)
+
+    html_header = """ <head><style>
+
+                    details {
+                        padding: 10px;
+                    }
+
+                    .table-wrapper {
+                        margin: 10px 70px 70px;
+                        box-shadow: 0px 35px 50px rgba( 0, 0, 0, 0.2 );
+                    }
+
+                    .fl-table {
+                        border-radius: 5px;
+                        font-size: 12px;
+                        font-weight: normal;
+                        border: none;
+                        border-collapse: collapse;
+                        width: 100%;
+                        max-width: 100%;
+                        white-space: nowrap;
+                        background-color: white;
+                    }
+
+                    .fl-table td, .fl-table th {
+                        text-align: center;
+                        padding: 8px;
+                    }
 
-        for key, value in parameters.items():
+                    .fl-table td {
+                        border: 1px solid #999999;
+                        font-size: 15px;
+                    }
 
-            if value != '':
-                statement = str(key) + ' = ' + '\'' + str(value) + '\' '
+                    .fl-table thead th {
+                        color: #ffffff;
+                        background: #4FC3A1;
+                        border: 1px solid #999999;
+                    }
 
-                if is_first_statement:
-                    is_first_statement = False
-                    where_clause += 'WHERE '
-                else:
-                    statement = 'AND ' + statement
 
-                where_clause += statement
+                    .fl-table thead th:nth-child(odd) {
+                        color: #ffffff;
+                        background: #324960;
+                    }
 
-        return where_clause
+                    .fl-table tr:nth-child(even) {
+                        background: #F8F8F8;
+                    }
 
+                    .title h2 {
+                      text-align: center;
+                      font-size: 22px;
+                      font-weight: 700; color:#202020;
+                      text-transform: uppercase;
+                      word-spacing: 1px; letter-spacing:2px;
+                      margin-bottom: 50px;
+                    }
 
-class ToolRunner:
+                    .title h2 span {
+                      padding-top: 40px;
+                      text-transform: none;
+                      font-size:.80em;
+                      font-weight: bold;
+                      font-family: "Playfair Display","Bookman",serif;
+                      color:#999;
+                      letter-spacing:-0.005em;
+                      word-spacing:1px;
+                      letter-spacing:none;
+                    }
 
-    def __init__(self,
-                 run_parameters,
-                 output,
-                 output_csv,
-                 output_html,
-                 output_basic_html,
-                 output_error):
+                    .title h1:before {
+                      background-color: #dfdfdf;
+                    }
 
-        self._raw_parameters_path = run_parameters
-        self._json_parameters = json.load(open(run_parameters, "r"))
-        self._archive_type = ''
-        self._query_type = ''
-        self._archives = []
-        self._adql_query = ''
-        self._services_access_url = ''
-        self._url_field = 'access_url'
-        self._number_of_files = ''
-        self._is_initialised = False
+                </style></head>"""
 
-        self._csv_file = False
-        self._image_file = False
-        self._html_file = False
-        self._basic_html_file = False
 
-        self._output = output
-        self._output_csv = output_csv
-        self._output_html = output_html
-        self._output_basic_html = output_basic_html
-        self._output_error = output_error
+class FileHandler:
+    # directory of the current run, daemon jobs do not change the one of
+    # the process
+    _working_directory = contextvars.ContextVar('working_directory',
+                                                default=None)
 
-        self._set_run_main_parameters()
+    def __init__(self):
+        pass
 
-        self._is_initialised, error_message = self._set_archive()
+    @staticmethod
+    def write_file_to_output(file, output, write_type="w"):
+        with open(output, write_type) as file_output:
+            file_output.write(file)
 
-        if self._is_initialised and error_message is None:
-            self._set_query()
-            self._set_output()
+    @staticmethod
+    @contextlib.contextmanager
+    def open_output(output, write_type="w"):
+        """
+        Open a path for writing, or pass an already open file through
+        """
+        if hasattr(output, 'write'):
+            yield output
+        else:
+            with open(output, write_type,
+                      buffering=DOWNLOAD_CHUNK_SIZE) as file_output:
+                yield file_output
 
-    def _set_run_main_parameters(self):
+    @staticmethod
+    def write_urls_to_output(resource_table,
+                             output,
+                             access_url="access_url"):
+        url_index = resource_table.get_column_index(access_url)
 
-        qs = "query_section"
-        qsl = "query_selection"
+        if url_index is None:
+            urls = [ResourceTable.MISSING] * len(resource_table)
+        else:
+            urls = resource_table.get_column(url_index)
 
-        self._archive_type = \
-            self._json_parameters['archive_selection']['archive_type']
-        self._query_type = \
-            self._json_parameters[qs][qsl]['query_type']
+        with FileHandler.open_output(output) as file_output:
+            for url in urls:
+                try:
+                    if url is ResourceTable.MISSING:
+                        raise KeyError(access_url)
 
-    def _set_archive(self):
+                    file_output.write(url + ',')
+                except Exception:
+                    error_message = "url field not found for url"
+                    Logger.create_action_log(
+                        Logger.ACTION_ERROR,
+                        Logger.ACTION_TYPE_WRITE_URL,
+                        error_message)
 
-        error_message = None
+    @staticmethod
+    def set_working_directory(directory):
+        FileHandler._working_directory.set(directory)
 
-        if self._archive_type == 'archive':
-            self._service_access_url =\
-                self._json_parameters['archive_selection']['archive']
+    @staticmethod
+    def get_working_directory():
+        return FileHandler._working_directory.get() or os.getcwd()
 
-            self._archives.append(
-                TapArchive(access_url=self._service_access_url))
+    @staticmethod
+    def get_subdir_path(index):
+        dir = FileHandler.get_working_directory()
 
-        else:
-            keyword = \
-                self._json_parameters['archive_selection']['keyword']
-            waveband = \
-                self._json_parameters['archive_selection']['wavebands']
-            service_type = \
-                self._json_parameters['archive_selection']['service_type']
+        dir += '/fits'
 
-            rsp = RegistrySearchParameters(
-                keyword=keyword,
-                waveband=waveband,
-                service_type=service_type)
+        return os.path.join(dir, str(index) + '.fits')
 
-            archive_list = Registry.search_registries(
-                rsp,
-                MAX_REGISTRIES_TO_SEARCH)
+    @staticmethod
+    def get_file_name_from_url(url, index=None):
+        url_parts = url.split('/')
 
-            if len(archive_list) >= 1:
-                self._archives = archive_list
-            else:
-                error_message = "no archive matching search parameters"
-                Logger.create_action_log(
-                    Logger.ACTION_ERROR,
-                    Logger.ACTION_TYPE_ARCHIVE_CONNECTION,
-                    error_message)
+        file_name = ''
 
-        if error_message is None:
+        try:
+            if (url_parts[-1]) != '':
+                file_name = url_parts[-1]
+            elif len(url_parts) > 1:
+                file_name = url_parts[-2]
+        except Exception:
+            file_name = 'archive file '
 
-            self._archives[:] = \
-                [archive for archive in self._archives if
-                 archive.initialize()[0]]
+        return file_name
 
-            if len(self._archives) >= 1:
-                return True, None
-            else:
-                return False, \
-                    "no archive matching search" \
-                    " parameters could be initialized"
 
-        else:
-            return False, error_message
+class Downloader:
+    """
+    Downloads files concurrently, streaming each response to disk in
+    chunks so memory use does not depend on the file size
+    """
 
-    def _set_cone_service(self):
+    def __init__(self,
+                 max_workers=MAX_DOWNLOAD_WORKERS,
+                 max_per_host=MAX_DOWNLOADS_PER_HOST,
+                 chunk_size=DOWNLOAD_CHUNK_SIZE,
+                 retries=DOWNLOAD_RETRIES,
+                 max_file_size=MAX_DOWNLOAD_FILE_SIZE,
+                 max_total_size=MAX_DOWNLOAD_TOTAL_SIZE,
+                 cache=None,
+                 session=None):
+
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.max_file_size = max_file_size
+        self.max_total_size = max_total_size
+        self.cache = cache
+        self.session = session or DeadlineSession.get_shared()
+
+        self._total_size = 0
+        self._lock = threading.Lock()
+        self._host_semaphores = {}
+
+    def download(self, downloads):
+        """
+        Download every (url, path) pair, yielding (url, path, exception)
+        in the order of downloads
+        """
 
-        qs = 'query_section'
-        qsl = 'query_selection'
-        csts = 'cone_search_target_selection'
+        task_pool = TaskPool(self.max_workers)
 
-        error_message = None
-        is_service_initialised = True
+        for (url, path), _, exception in task_pool.map(
+                lambda download: self.download_file(*download),
+                downloads):
+            yield url, path, exception
 
-        keyword = self._json_parameters[qs][qsl][csts]['keyword']
+    def download_file(self, url, path):
+        with Tracer.span('download', url=url) as span:
+            file_size = self._download_with_retries(url, path)
 
-        service_list = ConeServiceRegistry.search_services(
-            keyword,
-            MAX_REGISTRIES_TO_SEARCH)
+            span.set(bytes=file_size)
 
-        if len(service_list) >= 1:
-            self._services = service_list
-        else:
-            is_service_initialised = False
-            error_message = "no services matching search parameters"
-            Logger.create_action_log(
-                Logger.ACTION_ERROR,
-                Logger.ACTION_TYPE_ARCHIVE_CONNECTION,
-                error_message)
+        return file_size
 
-        return is_service_initialised, error_message
+    def _download_with_retries(self, url, path):
+        attempt = 0
 
-    def _set_query(self):
+        # the deadline covers every attempt, the host slot is released
+        # while waiting for the next one
+        download_deadline = Deadline(DOWNLOAD_TIMEOUT,
+                                     DOWNLOAD_CONNECT_TIMEOUT,
+                                     DOWNLOAD_FIRST_BYTE_TIMEOUT)
 
-        qs = 'query_section'
-        qsl = 'query_selection'
-        csts = 'cone_search_target_selection'
-        cs = 'cone_section'
-        ts = 'target_selection'
-        con = 'cone_object_name'
+        while True:
+            try:
+                with self._get_host_semaphore(url), download_deadline:
+                    return self._download_file(url, path)
+            except (DownloadBudgetException, TimeoutException):
+                raise
+            except Exception as e:
+                if attempt >= self.retries or \
+                        not Downloader._is_retryable(e):
+                    raise
 
-        if self._query_type == 'obscore_query':
+            time.sleep(DOWNLOAD_RETRY_BACKOFF * 2 ** attempt)
+            download_deadline.check()
+            attempt += 1
 
-            dataproduct_type = \
-                self._json_parameters[qs][qsl]['dataproduct_type']
-            obs_collection = \
-                self._json_parameters[qs][qsl]['obs_collection']
-            obs_title = \
-                self._json_parameters[qs][qsl]['obs_title']
-            obs_id = \
-                self._json_parameters[qs][qsl]['obs_id']
-            facility_name = \
-                self._json_parameters[qs][qsl]['facility_name']
-            instrument_name = \
-                self._json_parameters[qs][qsl]['instrument_name']
-            em_min = \
-                self._json_parameters[qs][qsl]['em_min']
-            em_max = \
-                self._json_parameters[qs][qsl]['em_max']
-            target_name = \
-                self._json_parameters[qs][qsl]['target_name']
-            obs_publisher_id = \
-                self._json_parameters[qs][qsl]['obs_publisher_id']
-            s_fov = \
-                self._json_parameters[qs][qsl]['s_fov']
-            calibration_level = \
-                self._json_parameters[qs][qsl]['calibration_level']
-            t_min = \
-                self._json_parameters[qs][qsl]['t_min']
-            t_max = \
-                self._json_parameters[qs][qsl]['t_max']
-            order_by = \
-                self._json_parameters[qs][qsl]['order_by']
+    def _download_file(self, url, path):
+        if self.cache is None:
+            return self._download_to_path(url, path)
 
-            if self._json_parameters[qs][qsl][cs][csts][ts] == 'coordinates':
-                ra = self._json_parameters[qs][qsl][cs][csts]['ra']
-                dec = self._json_parameters[qs][qsl][cs][csts]['dec']
+        return self._download_cached(url, path)
+
+    def _download_to_path(self, url, path):
+        part_path = path + '.part'
+
+        try:
+            with self._get(url) as response, \
+                    open(part_path, 'wb') as file_output:
+                response.raise_for_status()
+                file_size = self._write_response(response, file_output)
+
+            os.replace(part_path, path)
+        except BaseException:
+            try:
+                os.remove(part_path)
+            except OSError:
+                pass
+
+            raise
+
+        return file_size
+
+    def _download_cached(self, url, path):
+        entry = self.cache.get_entry(url)
+
+        with self.cache.open_partial(url) as partial:
+
+            # another process is already fetching this url into the cache
+            if partial is None:
+                return self._download_to_path(url, path)
+
+            if entry is not None:
+                headers = DownloadCache.get_validation_headers(entry)
             else:
-                obs_target = self._json_parameters[qs][qsl][cs][csts][con]
+                headers = partial.get_range_headers()
+
+            response = self._get(url, headers)
+
+            # the partial file is not a prefix of the file on the server
+            # any more, it changed or the partial file is complete
+            if response.status_code == 416 and 'Range' in headers:
+                response.close()
+                partial.restart({})
+                response = self._get(url)
+
+            with response:
+                if response.status_code == 304 and entry is not None:
+                    return self.cache.serve(entry, path)
+
+                response.raise_for_status()
+
+                if entry is not None and \
+                        DownloadCache.is_unchanged(entry, response.headers):
+                    return self.cache.serve(entry, path)
 
-                if obs_target != 'none' and obs_target is not None:
-                    target = CelestialObject(obs_target)
-                    target_coordinates = target.get_coordinates_in_degrees()
+                if response.status_code != 206:
+                    partial.restart(response.headers)
 
-                    ra = target_coordinates['ra']
-                    dec = target_coordinates['dec']
-                else:
-                    ra = None
-                    dec = None
+                self._write_response(response,
+                                     partial.file,
+                                     partial.offset,
+                                     partial.digest)
 
-            radius = self._json_parameters[qs][qsl][cs]['radius']
+            entry = self.cache.store(url, partial, response.headers)
 
-            if (ra != '' and ra is not None)\
-                    and (dec != '' and dec is not None)\
-                    and (radius != '' and radius is not None):
-                cone_condition = \
-                    ADQLConeSearchQuery.get_search_circle_condition(ra,
-                                                                    dec,
-                                                                    radius)
-            else:
-                cone_condition = None
+        return self.cache.serve(entry, path)
 
-            obscore_query_object = ADQLObscoreQuery(dataproduct_type,
-                                                    obs_collection,
-                                                    obs_title,
-                                                    obs_id,
-                                                    facility_name,
-                                                    instrument_name,
-                                                    em_min,
-                                                    em_max,
-                                                    target_name,
-                                                    obs_publisher_id,
-                                                    s_fov,
-                                                    calibration_level,
-                                                    t_min,
-                                                    t_max,
-                                                    cone_condition,
-                                                    order_by)
-
-            self._adql_query = obscore_query_object.get_query()
+    def _get(self, url, headers=None):
+        return self.session.get(url, headers=headers, stream=True)
 
-        elif self._query_type == 'raw_query':
+    def _write_response(self, response, file_output, offset=0, digest=None):
+        file_size = 0
 
-            wc = 'where_clause'
+        try:
+            for chunk in response.iter_content(self.chunk_size):
+                Deadline.check_current()
 
-            tap_table = \
-                self._json_parameters[qs][qsl]['table']
+                self._reserve(len(chunk), offset + file_size + len(chunk))
+                file_size += len(chunk)
 
-            where_field = \
-                self._json_parameters[qs][qsl][wc]['where_field']
-            where_condition = \
-                self._json_parameters[qs][qsl][wc]['where_condition']
+                file_output.write(chunk)
 
-            self._url_field = \
-                self._json_parameters[qs][qsl]['url_field']
+                if digest is not None:
+                    digest.update(chunk)
+        except BaseException:
+            self._release(file_size)
+            raise
 
-            self._adql_query = \
-                ADQLTapQuery().get_query(
-                    tap_table,
-                    where_field,
-                    where_condition)
-        else:
-            self._adql_query = ADQLObscoreQuery.base_query
+        return file_size
 
-    def _set_cone_query(self):
+    def _reserve(self, chunk_size, file_size):
+        if file_size > self.max_file_size:
+            raise DownloadBudgetException('file size budget exceeded')
 
-        qs = 'query_section'
-        qsl = 'query_selection'
-        csts = 'cone_search_target_selection'
-        ts = 'target_selection'
-        con = 'cone_object_name'
+        with self._lock:
+            if self._total_size + chunk_size > self.max_total_size:
+                raise DownloadBudgetException('total size budget exceeded')
 
-        search_radius = self._json_parameters[qs][qsl]['radius']
-        time = None
+            self._total_size += chunk_size
 
-        if self._json_parameters[qs][qsl][csts][ts] == 'coordinates':
-            ra = self._json_parameters[qs][qsl][csts]['ra']
-            dec = self._json_parameters[qs][qsl][csts]['dec']
-            time = self._json_parameters[qs][qsl][csts]['time']
-        else:
-            target = CelestialObject(self._json_parameters[qs][qsl][csts][con])
+    def _release(self, size):
+        with self._lock:
+            self._total_size -= size
 
-            target_coordinates = target.get_coordinates_in_degrees()
+    def _get_host_semaphore(self, url):
+        host = urllib.parse.urlparse(url).netloc
 
-            ra = target_coordinates['ra']
-            dec = target_coordinates['dec']
+        with self._lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = \
+                    threading.BoundedSemaphore(self.max_per_host)
 
-        cone_query_object = ADQLConeSearchQuery(ra, dec, search_radius, time)
+            return self._host_semaphores[host]
 
-        self._adql_query = cone_query_object.get_query()
+    @staticmethod
+    def _is_retryable(exception):
+        if isinstance(exception, requests.exceptions.HTTPError):
+            status_code = exception.response.status_code
 
-    def _set_output(self):
-        self._number_of_files = \
-            int(
-                self._json_parameters['output_section']['number_of_files']
-            )
+            return status_code == 429 or status_code >= 500
 
-        if self._number_of_files < 1:
-            self._number_of_files = 1
-        elif self._number_of_files > 100:
-            self._number_of_files = MAX_ALLOWED_ENTRIES
+        return isinstance(exception, OSError)
 
-        output_selection = \
-            self._json_parameters['output_section']['output_selection']
 
-        if output_selection is not None:
-            if 'c' in output_selection:
-                self._csv_file = True
-            if 'i' in output_selection:
-                self._image_file = True
-            if 'h' in output_selection:
-                self._html_file = True
-            if 'b' in output_selection:
-                self._basic_html_file = True
+class PartialDownload:
 
-    def _validate_json_parameters(self, json_parameters):
-        self._json_parameters = json.load(open(json_parameters, "r"))
+    def __init__(self, path):
+        self.path = path
+        self.meta_path = path + '.json'
+        self.file = None
+        self.offset = 0
+        self.validator = None
+        self.digest = hashlib.sha256()
 
-    def run(self):
-        if self._is_initialised:
-            error_message = None
-            file_url = []
+    def open(self):
+        self.file = open(self.path, 'a+b')
 
-            archive_name = self._archives[0].get_archive_name(
-                self._archive_type)
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.file.close()
+            self.file = None
+            return False
 
-            for archive in self._archives:
-                try:
-                    _file_url, error_message = archive.get_resources(
-                        self._adql_query,
-                        self._number_of_files,
-                        self._url_field)
+        try:
+            with open(self.meta_path, 'r') as meta_file:
+                self.validator = json.load(meta_file).get('validator')
+        except (OSError, ValueError):
+            self.validator = None
 
-                    file_url.extend(_file_url)
-                except TimeoutException:
-                    error_message = \
-                        "Archive is taking too long to respond (timeout)"
-                    Logger.create_action_log(
-                        Logger.ACTION_ERROR,
-                        Logger.ACTION_TYPE_ARCHIVE_CONNECTION,
-                        error_message)
+        if self.validator is None:
+            self.file.truncate(0)
 
-                if len(file_url) >= int(self._number_of_files):
-                    file_url = file_url[:int(self._number_of_files)]
-                    break
+        self.file.seek(0)
 
-            if file_url:
+        for chunk in iter(lambda: self.file.read(DOWNLOAD_CHUNK_SIZE), b''):
+            self.digest.update(chunk)
 
-                if self._csv_file:
-                    FileHandler.write_urls_to_output(
-                        file_url,
-                        self._output_csv,
-                        self._url_field)
+        self.offset = self.file.tell()
 
-                if self._image_file:
+        return True
 
-                    try:
-                        fits_file = FileHandler.download_file_from_url(
-                            file_url[0][self._url_field])
+    def close(self):
+        if self.file is not None:
+            self.file.close()
 
-                        FileHandler.write_file_to_output(
-                            fits_file,
-                            self._output, "wb")
+    def get_range_headers(self):
+        if self.offset == 0 or self.validator is None:
+            return {}
 
-                        log_message = "from url " +\
-                                      file_url[0][self._url_field]
+        return {
+            'Range': 'bytes=' + str(self.offset) + '-',
+            'If-Range': self.validator
+        }
 
-                        Logger.create_action_log(
-                            Logger.ACTION_SUCCESS,
-                            Logger.ACTION_TYPE_DOWNLOAD,
-                            log_message)
+    def restart(self, headers):
+        self.file.truncate(0)
+        self.file.seek(0)
+        self.offset = 0
+        self.digest = hashlib.sha256()
 
-                    except Exception:
-                        error_message = "from url " + \
-                                        file_url[0][self._url_field]
+        # only strong validators can be used to resume with If-Range
+        etag = headers.get('ETag')
 
-                        Logger.create_action_log(
-                            Logger.ACTION_ERROR,
-                            Logger.ACTION_TYPE_DOWNLOAD,
-                            error_message)
+        if etag and not etag.startswith('W/'):
+            self.validator = etag
+        else:
+            self.validator = headers.get('Last-Modified')
 
-                    for i, url in enumerate(file_url[1:], start=1):
-                        try:
-                            fits_file = \
-                                FileHandler.download_file_from_url(
-                                    url[self._url_field])
+        with open(self.meta_path, 'w') as meta_file:
+            json.dump({'validator': self.validator}, meta_file)
 
-                            FileHandler.write_file_to_subdir(
-                                fits_file,
-                                FileHandler.get_file_name_from_url(
-                                    url[self._url_field]))
+    def remove(self):
+        for path in [self.path, self.meta_path]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
 
-                            log_message = "from url " + \
-                                          url[self._url_field]
 
-                            Logger.create_action_log(
-                                Logger.ACTION_SUCCESS,
-                                Logger.ACTION_TYPE_DOWNLOAD,
-                                log_message)
+class DownloadCache:
+    """
+    Content addressed store of downloaded files. An index maps each url
+    to the sha256 of its content and to the validators of the response
+    """
 
-                        except Exception:
-                            error_message = "from url " + \
-                                            url[self._url_field]
+    def __init__(self,
+                 directory=DOWNLOAD_CACHE_DIRECTORY,
+                 max_size=DOWNLOAD_CACHE_MAX_SIZE):
 
-                            Logger.create_action_log(
-                                Logger.ACTION_ERROR,
-                                Logger.ACTION_TYPE_DOWNLOAD,
-                                error_message)
+        self.objects_directory = os.path.join(directory, 'files', 'objects')
+        self.partial_directory = os.path.join(directory, 'files', 'partial')
+        self.size_path = os.path.join(directory, 'files', 'size')
+        self.max_size = max_size
+        self.index = FileCache('files_index',
+                               DOWNLOAD_CACHE_TTL,
+                               DOWNLOAD_CACHE_MAX_ENTRIES,
+                               directory)
 
-                if self._html_file:
-                    html_file = OutputHandler.generate_html_output(
-                        file_url,
-                        archive_name,
-                        self._adql_query)
+        os.makedirs(self.objects_directory, exist_ok=True)
+        os.makedirs(self.partial_directory, exist_ok=True)
 
-                    FileHandler.write_file_to_output(html_file,
-                                                     self._output_html)
+    @staticmethod
+    def get_cache():
+        # files can be large, the cache is only used when a directory is
+        # set for it
+        if not DOWNLOAD_CACHE_DIRECTORY:
+            return None
 
-                if self._basic_html_file:
-                    html_file = \
-                        OutputHandler.generate_basic_html_output(
-                            file_url,
-                            archive_name,
-                            self._adql_query)
+        try:
+            return DownloadCache()
+        except OSError:
+            return None
 
-                    FileHandler.write_file_to_output(
-                        html_file,
-                        self._output_basic_html)
+    def get_entry(self, url):
+        entry = self.index.get(url)
 
-                summary_file = Logger.create_log_file(archive_name,
-                                                      self._adql_query)
-                summary_file += "\n Tool run executed with success"
+        if entry is None or \
+                not os.path.isfile(self._get_object_path(entry['digest'])):
+            return None
 
-                FileHandler.write_file_to_output(summary_file,
-                                                 self._output_error)
+        return entry
 
-            else:
+    @contextlib.contextmanager
+    def open_partial(self, url):
+        file_name = hashlib.sha256(url.encode('utf-8')).hexdigest()
 
-                summary_file = Logger.create_log_file(archive_name,
-                                                      self._adql_query)
+        partial = PartialDownload(
+            os.path.join(self.partial_directory, file_name))
 
-                if error_message is None:
-                    summary_file += \
-                        "\n No resources matching parameters found"
-                else:
-                    summary_file += error_message
+        if not partial.open():
+            yield None
+            return
 
-                FileHandler.write_file_to_output(summary_file,
-                                                 self._output_error)
-        else:
-            summary_file = Logger.create_log_file("Archive",
-                                                  self._adql_query)
+        try:
+            yield partial
+        finally:
+            partial.close()
 
-            summary_file += "Unable to initialize archives"
+    def store(self, url, partial, headers):
+        digest = partial.digest.hexdigest()
+        object_path = self._get_object_path(digest)
 
-            FileHandler.write_file_to_output(summary_file,
-                                             self._output_error)
+        partial.file.flush()
 
+        is_new_object = not os.path.isfile(object_path)
 
-class ADQLObscoreQuery(BaseADQLQuery):
-    order_by_field = {
-        'size': 'access_estsize',
-        'collection': 'obs_collection',
-        'object': 'target_name'
-    }
+        if is_new_object:
+            os.replace(partial.path, object_path)
 
-    base_query = 'SELECT TOP ' + \
-                 str(MAX_ALLOWED_ENTRIES) + \
-                 ' * FROM ivoa.obscore '
+        partial.remove()
 
-    def __init__(self,
-                 dataproduct_type,
-                 obs_collection,
-                 obs_title,
-                 obs_id,
-                 facility_name,
-                 instrument_name,
-                 em_min,
-                 em_max,
-                 target_name,
-                 obs_publisher_id,
-                 s_fov,
-                 calibration_level,
-                 t_min,
-                 t_max,
-                 cone_condition,
-                 order_by):
+        entry = {
+            'digest': digest,
+            'size': os.path.getsize(object_path),
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified')
+        }
 
-        super().__init__()
+        self.index.set(url, entry)
 
-        if calibration_level == 'none':
-            calibration_level = ''
+        if is_new_object:
+            self._add_size(entry['size'])
 
-        if order_by == 'none':
-            order_by = ''
+        return entry
 
-        if t_min == 'None' or t_min is None:
-            t_min = ''
+    def serve(self, entry, path):
+        object_path = self._get_object_path(entry['digest'])
+        part_path = path + '.part'
 
-        if t_max == 'None' or t_max is None:
-            t_max = ''
+        # outputs are copies, a job changing its file cannot alter the
+        # cached object
+        try:
+            shutil.copyfile(object_path, part_path)
+            os.replace(part_path, path)
+        except BaseException:
+            try:
+                os.remove(part_path)
+            except OSError:
+                pass
 
-        if em_min == 'None' or em_min is None:
-            em_min = ''
+            raise
 
-        if em_max == 'None' or em_max is None:
-            em_max = ''
+        os.utime(object_path)
 
-        if dataproduct_type == 'none' or dataproduct_type is None:
-            dataproduct_type = ''
+        return entry['size']
 
-        if cone_condition is not None:
-            self.cone_condition = cone_condition
-        else:
-            self.cone_condition = None
+    @staticmethod
+    def get_validation_headers(entry):
+        headers = {}
 
-        self.parameters = {
-            'dataproduct_type': dataproduct_type,
-            'obs_collection': obs_collection,
-            'obs_title': obs_title,
-            'obs_id': obs_id,
-            'facility_name': facility_name,
-            'instrument_name': instrument_name,
-            'em_min': em_min,
-            'em_max': em_max,
-            'target_name': target_name,
-            'obs_publisher_id': obs_publisher_id,
-            's_fov': s_fov,
-            'calib_level': calibration_level,
-            't_min': t_min,
-            't_max': t_max,
-        }
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        elif entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
 
-        self.order_by = order_by
+        return headers
 
-    def get_query(self):
-        return ADQLObscoreQuery.base_query + \
-            self.get_where_statement() + \
-            self.get_order_by_statement()
+    @staticmethod
+    def is_unchanged(entry, headers):
+        if entry.get('etag') and headers.get('ETag'):
+            return entry['etag'] == headers.get('ETag')
 
-    def get_order_by_statement(self):
-        if self.order_by != '':
-            return self._get_order_by_clause(self.order_by)
-        else:
-            return ''
+        if entry.get('last_modified') and headers.get('Last-Modified'):
+            return entry['last_modified'] == headers.get('Last-Modified')
 
-    def _get_order_by_clause(self, order_type):
+        return headers.get('Content-Length') == str(entry['size'])
 
-        obscore_order_type = ADQLObscoreQuery.order_by_field[order_type]
+    def _add_size(self, size):
+        """
+        Keep a running total of the objects size, the objects are only
+        listed to evict the least recently used ones once it goes over
+        max_size
+        """
 
-        return super()._get_order_by_clause(obscore_order_type)
+        with open(self.size_path, 'a+') as size_file:
+            fcntl.flock(size_file, fcntl.LOCK_EX)
 
-    def get_where_statement(self):
-        where_clause = self._get_where_clause(self.parameters)
+            size_file.seek(0)
 
-        if where_clause == '' and self.cone_condition is not None:
-            where_clause = 'WHERE ' + self.get_cone_condition()
-        elif where_clause != '' and self.cone_condition is not None:
-            where_clause += 'AND ' + self.get_cone_condition()
+            try:
+                total_size = int(size_file.read()) + size
+            except ValueError:
+                total_size = None
 
-        return where_clause
+            if total_size is None or total_size > self.max_size:
+                total_size = self._evict()
 
-    def _get_where_clause(self, parameters):
-        return super()._get_where_clause(parameters)
+            size_file.seek(0)
+            size_file.truncate()
+            size_file.write(str(total_size))
 
-    def get_cone_condition(self):
-        return self.cone_condition
+    def _evict(self):
+        objects = []
 
+        for file_name in os.listdir(self.objects_directory):
+            object_path = os.path.join(self.objects_directory, file_name)
 
-class ADQLTapQuery(BaseADQLQuery):
-    base_query = 'SELECT TOP '+str(MAX_ALLOWED_ENTRIES)+' * FROM '
+            try:
+                object_stat = os.stat(object_path)
+            except OSError:
+                continue
 
-    def __init__(self):
-        super().__init__()
+            objects.append((object_stat.st_mtime,
+                            object_stat.st_size,
+                            object_path))
 
-    def get_order_by_clause(self, order_type):
-        return super()._get_order_by_clause(order_type)
+        total_size = sum(object_size for _, object_size, _ in objects)
 
-    def get_query(self, table, where_field, where_condition):
-        if where_field != '' and where_condition != '':
-            return ADQLTapQuery.base_query + \
-                str(table) + \
-                ' WHERE ' + \
-                str(where_field) + ' = ' + '\'' + \
-                str(where_condition) + '\''
-        else:
-            return ADQLTapQuery.base_query + str(table)
+        for _, object_size, object_path in sorted(objects):
+            if total_size <= self.max_size:
+                break
+
+            try:
+                os.remove(object_path)
+                total_size -= object_size
+            except OSError:
+                pass
 
+        return total_size
 
-class ADQLConeSearchQuery:
+    def _get_object_path(self, digest):
+        return os.path.join(self.objects_directory, digest)
 
-    base_query = "SELECT TOP 100 * FROM ivoa.obscore"
 
-    def __init__(self, ra, dec, radius, time=None):
+class MissingValue:
+    """
+    Placeholder for a column a resource does not have, rendered empty
+    """
 
-        self.ra = ra
-        self.dec = dec
-        self.radius = radius
-        self.time = time
+    def __str__(self):
+        return ''
 
-        self._query = ADQLObscoreQuery.base_query
+    def __repr__(self):
+        return 'MISSING'
 
-        if self.ra and self.dec and self.radius:
-            self._query += " WHERE "
-            self._query += self._get_search_circle(ra, dec, radius)
 
-            if self.time:
-                self._query += self._get_search_time()
+class ResourceTable:
+    """
+    Query results held column by column, one sequence per key. Columns
+    are python lists for streamed rows or the arrays astropy parsed
+    """
 
-    def _get_search_circle(self, ra, dec, radius):
-        return "(CONTAINS" \
-               "(POINT('ICRS', s_ra, s_dec), " \
-               "CIRCLE('ICRS', "+str(ra)+", "+str(dec)+", "+str(radius)+")" \
-               ") = 1)"
+    MISSING = MissingValue()
 
-    def _get_search_time(self):
-        return " AND t_min <= "+self.time+" AND t_max >= "+self.time
+    def __init__(self, keys=(), columns=()):
+        self.keys = list(keys)
+        self.columns = list(columns)
+        self.key_index = {key: i for i, key in enumerate(self.keys)}
 
-    def get_query(self):
-        return self._query
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
 
     @staticmethod
-    def get_search_circle_condition(ra, dec, radius):
-        return "(CONTAINS" \
-               "(POINT('ICRS', s_ra, s_dec)," \
-               "CIRCLE('ICRS', "+str(ra)+", "+str(dec)+", "+str(radius)+")" \
-               ") = 1) "
+    def from_resources(urls_data):
+        keys = Utils.collect_resource_keys(urls_data)
+
+        return ResourceTable(
+            keys,
+            [[resource.get(key, ResourceTable.MISSING)
+              for resource in urls_data]
+             for key in keys])
+
+    @staticmethod
+    def concatenate(tables):
+        """
+        Merge tables column by column, keys missing from a table are
+        filled with MISSING
+        """
+        tables = [table for table in tables if len(table)]
+
+        if len(tables) == 1:
+            return tables[0]
+
+        keys = Utils.collect_resource_keys(table.keys for table in tables)
+        columns = []
 
+        for key in keys:
+            column = []
 
-class CelestialObject:
+            for table in tables:
+                index = table.get_column_index(key)
 
-    def __init__(self, name):
-        self.name = name
-        self.coordinates = None
+                if index is None:
+                    column.extend([ResourceTable.MISSING] * len(table))
+                else:
+                    column.extend(table.columns[index])
 
-        self.coordinates = SkyCoord.from_name(self.name)
+            columns.append(column)
 
-    def get_coordinates_in_degrees(self):
+        return ResourceTable(keys, columns)
 
-        coordinates = {
-            'ra': '',
-            'dec': ''
-        }
+    def get_column_index(self, key):
+        return self.key_index.get(key)
 
-        ra_dec = self.coordinates.ravel()
+    def get_column(self, index):
+        return self.columns[index]
 
-        coordinates['ra'] = ra_dec.ra.degree[0]
-        coordinates['dec'] = ra_dec.dec.degree[0]
+    def get_rows(self, start=0, stop=None):
+        return zip(*(column[start:stop] for column in self.columns))
 
-        return coordinates
+    def head(self, number_of_rows):
+        return ResourceTable(self.keys,
+                             [column[:number_of_rows]
+                              for column in self.columns])
 
+    def take(self, indices):
+        return ResourceTable(self.keys,
+                             [ResourceTable._take(column, indices)
+                              for column in self.columns])
 
-class HTMLReport:
-    _html_report_base_header = ''
-    _html_report_base_body = ''
-    _html_report_base_footer = ''
-    _html_report_base_script = ''
+    def sort(self, key):
+        """
+        Stable ascending sort on a column, empty values last
+        """
+        index = self.get_column_index(key)
 
-    def __init__(self):
-        pass
+        if index is None:
+            return self
 
+        column = self.columns[index]
 
-class OutputHandler:
+        def get_sort_key(i):
+            value = column[i]
 
-    def __init__(self):
-        pass
+            if ResourceTable.is_null(value):
+                return (1, 0)
 
-    @staticmethod
-    def generate_html_output(urls_data, archive_name, adql_query):
-        return OutputHandler.html_header + \
-            OutputHandler.generate_html_content(
-                urls_data,
-                archive_name,
-                adql_query,
-                div_attr='class="title"',
-                table_attr='class="fl-table"')
+            return (0, value)
+
+        try:
+            order = sorted(range(len(self)), key=get_sort_key)
+        except TypeError:
+            # archives disagree on the column type, compare as text
+            order = sorted(range(len(self)),
+                           key=lambda i: (ResourceTable.is_null(column[i]),
+                                          str(column[i])))
+
+        return self.take(order)
 
     @staticmethod
-    def generate_basic_html_output(urls_data,
-                                   archive_name,
-                                   adql_query, ):
-        return OutputHandler.generate_html_content(urls_data,
-                                                   archive_name,
-                                                   adql_query)
+    def is_null(value):
+        return value is None or \
+            value is ResourceTable.MISSING or \
+            value is numpy.ma.masked
 
     @staticmethod
-    def generate_html_content(urls_data, archive_name, adql_query,
-                              div_attr="", table_attr="border='1'"):
-        html_file = \
-            f"""
-                    <div {div_attr}>
-                        <h2>Resources Preview archive:
-                            <span>
-                                {archive_name}
-                            </span>
-                        </h2>
-                        <span>ADQL query : {adql_query}</span>
-                    </div>"""
+    def _take(column, indices):
+        if isinstance(column, list):
+            return [column[i] for i in indices]
 
-        html_file += f'<table {table_attr}><thead><tr>'
+        return column[list(indices)]
 
-        for key in Utils.collect_resource_keys(urls_data):
-            html_file += '<th>' + str(key) + '</th>'
 
-        html_file += '</thead></tr><tbody>'
+class ResourceMerger:
+    """
+    Merge the results of several archives, skipping resources already
+    returned by another archive. Resources are identified by their
+    obs_publisher_id or url, or by their whole content when they have
+    neither
+    """
 
-        for resource in urls_data:
-            html_file += '<tr>'
-
-            for key, value in resource.items():
-                html_file += f'<td>{value}</td>'
-
-            html_file += '<td>'
-            for preview_key in \
-                    ['preview', 'preview_url', 'postcard_url']:
-                if preview_key in resource:
-                    html_file += (
-                        '<details><summary>Preview</summary>'
-                        f'<img src="{resource[preview_key]}"/>'
-                        '</details>'
-                    )
-            html_file += '</td>'
-            html_file += '</tr>'
-
-        html_file += '</tbody></table>'
-        return html_file
+    def __init__(self, url_field='access_url', order_by=None):
+        self.identifier_keys = ['obs_publisher_id', url_field]
+        self.order_by = order_by
+        self._seen = set()
+        self._tables = []
+        self._length = 0
 
-    html_header = """ <head><style>
+    def __len__(self):
+        return self._length
 
-                    details {
-                        padding: 10px;
-                    }
+    def add(self, resource_table):
+        identifier_columns = [
+            (key, resource_table.get_column(index))
+            for key, index in
+            ((key, resource_table.get_column_index(key))
+             for key in dict.fromkeys(self.identifier_keys))
+            if index is not None]
 
-                    .table-wrapper {
-                        margin: 10px 70px 70px;
-                        box-shadow: 0px 35px 50px rgba( 0, 0, 0, 0.2 );
-                    }
+        rows = None
+        kept = []
 
-                    .fl-table {
-                        border-radius: 5px;
-                        font-size: 12px;
-                        font-weight: normal;
-                        border: none;
-                        border-collapse: collapse;
-                        width: 100%;
-                        max-width: 100%;
-                        white-space: nowrap;
-                        background-color: white;
-                    }
+        for i in range(len(resource_table)):
+            identifiers = [(key, str(column[i]))
+                           for key, column in identifier_columns
+                           if not ResourceTable.is_null(column[i])]
 
-                    .fl-table td, .fl-table th {
-                        text-align: center;
-                        padding: 8px;
-                    }
+            if not identifiers:
+                if rows is None:
+                    rows = list(resource_table.get_rows())
 
-                    .fl-table td {
-                        border: 1px solid #999999;
-                        font-size: 15px;
-                    }
+                identifiers = [('content', tuple(map(str, rows[i])))]
 
-                    .fl-table thead th {
-                        color: #ffffff;
-                        background: #4FC3A1;
-                        border: 1px solid #999999;
-                    }
+            if any(identifier in self._seen for identifier in identifiers):
+                continue
 
+            self._seen.update(identifiers)
+            kept.append(i)
 
-                    .fl-table thead th:nth-child(odd) {
-                        color: #ffffff;
-                        background: #324960;
-                    }
+        if len(kept) < len(resource_table):
+            resource_table = resource_table.take(kept)
 
-                    .fl-table tr:nth-child(even) {
-                        background: #F8F8F8;
-                    }
+        self._tables.append(resource_table)
+        self._length += len(resource_table)
 
-                    .title h2 {
-                      text-align: center;
-                      font-size: 22px;
-                      font-weight: 700; color:#202020;
-                      text-transform: uppercase;
-                      word-spacing: 1px; letter-spacing:2px;
-                      margin-bottom: 50px;
-                    }
+    def get_table(self, number_of_results):
+        resource_table = ResourceTable.concatenate(self._tables)
 
-                    .title h2 span {
-                      padding-top: 40px;
-                      text-transform: none;
-                      font-size:.80em;
-                      font-weight: bold;
-                      font-family: "Playfair Display","Bookman",serif;
-                      color:#999;
-                      letter-spacing:-0.005em;
-                      word-spacing:1px;
-                      letter-spacing:none;
-                    }
+        if self.order_by:
+            resource_table = resource_table.sort(self.order_by)
 
-                    .title h1:before {
-                      background-color: #dfdfdf;
-                    }
+        return resource_table.head(number_of_results)
 
-                </style></head>"""
 
+class TableExporter:
+    """
+    Write every column of the resources as a typed table. Rows are
+    typed and written one at a time, Parquet row groups hold
+    EXPORT_BATCH_SIZE rows
+    """
 
-class FileHandler:
+    VOTABLE_TYPES = {
+        'boolean': ('boolean', None),
+        'long': ('long', None),
+        'double': ('double', None),
+        'char': ('unicodeChar', '*'),
+    }
 
     def __init__(self):
         pass
 
     @staticmethod
-    def download_file_from_url(file_url):
-        with request.urlopen(file_url) as response:
-            fits_file = response.read()
+    def write_table(resource_table, output, table_format='csv'):
+        column_types = [
+            TableExporter.get_column_type(resource_table.get_column(i))
+            for i in range(len(resource_table.keys))]
+
+        rows = TableExporter._iter_rows(resource_table, column_types)
+
+        if table_format == 'parquet':
+            TableExporter._write_parquet(resource_table.keys,
+                                         column_types,
+                                         rows,
+                                         output)
+        elif table_format == 'votable':
+            TableExporter._write_votable(resource_table.keys,
+                                         column_types,
+                                         rows,
+                                         output)
+        else:
+            TableExporter._write_csv(resource_table.keys, rows, output)
+
+    @staticmethod
+    def get_column_type(values):
+        column_type = None
+
+        for value in values:
+            if ResourceTable.is_null(value):
+                continue
+            elif isinstance(value, (bool, numpy.bool_)):
+                value_type = 'boolean'
+            elif isinstance(value, numbers.Integral):
+                value_type = 'long'
+            elif isinstance(value, numbers.Real):
+                value_type = 'double'
+            else:
+                return 'char'
 
-        return fits_file
+            if column_type is None:
+                column_type = value_type
+            elif column_type != value_type:
+                if {column_type, value_type} == {'long', 'double'}:
+                    column_type = 'double'
+                else:
+                    return 'char'
+
+        return column_type or 'char'
 
     @staticmethod
-    def write_file_to_output(file, output, write_type="w"):
-        with open(output, write_type) as file_output:
-            file_output.write(file)
+    def _get_value(value, column_type):
+        if ResourceTable.is_null(value):
+            return None
+        elif column_type == 'boolean':
+            return bool(value)
+        elif column_type == 'long':
+            return int(value)
+        elif column_type == 'double':
+            return float(value)
+        elif isinstance(value, bytes):
+            return value.decode('utf-8', 'replace')
+        else:
+            return str(value)
 
     @staticmethod
-    def write_urls_to_output(urls: [], output, access_url="access_url"):
-        with open(output, "w") as file_output:
-            for url in urls:
-                try:
-                    file_output.write(url[access_url] + ',')
-                except Exception:
-                    error_message = "url field not found for url"
-                    Logger.create_action_log(
-                        Logger.ACTION_ERROR,
-                        Logger.ACTION_TYPE_WRITE_URL,
-                        error_message)
+    def _iter_rows(resource_table, column_types):
+        for row in zip(*resource_table.columns):
+            yield [TableExporter._get_value(value, column_type)
+                   for value, column_type in zip(row, column_types)]
 
     @staticmethod
-    def write_file_to_subdir(file, index):
-        dir = os.getcwd()
+    def _write_csv(keys, rows, output):
+        with FileHandler.open_output(output) as file_output:
+            writer = csv.writer(file_output, lineterminator='\n')
+            writer.writerow(keys)
 
-        dir += '/fits'
+            writer.writerows(
+                ['' if value is None else value for value in row]
+                for row in rows)
+
+    @staticmethod
+    def _write_parquet(keys, column_types, rows, output):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError('Parquet export requires pyarrow')
+
+        arrow_types = {
+            'boolean': pyarrow.bool_(),
+            'long': pyarrow.int64(),
+            'double': pyarrow.float64(),
+            'char': pyarrow.string(),
+        }
 
-        upload_dir = os.path.join(dir, str(index) + '.fits')
+        schema = pyarrow.schema(
+            [(str(key), arrow_types[column_type])
+             for key, column_type in zip(keys, column_types)])
 
-        with open(upload_dir, "wb") as file_output:
-            file_output.write(file)
+        with pyarrow.parquet.ParquetWriter(output, schema) as writer:
+            for batch in iter(
+                    lambda: list(itertools.islice(rows, EXPORT_BATCH_SIZE)),
+                    []):
+                columns = [
+                    pyarrow.array(column, type=field.type)
+                    for column, field in zip(zip(*batch), schema)]
+
+                writer.write_batch(
+                    pyarrow.record_batch(columns, schema=schema))
 
     @staticmethod
-    def get_file_name_from_url(url, index=None):
-        url_parts = url.split('/')
+    def _write_votable(keys, column_types, rows, output):
+        """
+        Write a BINARY2 serialized VOTable, base64 encoded as rows come
+        """
+        with FileHandler.open_output(output) as file_output:
+            file_output.write(
+                '<?xml version="1.0" encoding="utf-8"?>\n'
+                '<VOTABLE version="1.3" '
+                'xmlns="http://www.ivoa.net/xml/VOTable/v1.3">\n'
+                '<RESOURCE type="results">\n<TABLE>\n')
 
-        file_name = ''
+            for key, column_type in zip(keys, column_types):
+                datatype, arraysize = TableExporter.VOTABLE_TYPES[column_type]
+                arraysize = f' arraysize="{arraysize}"' if arraysize else ''
 
-        try:
-            if (url_parts[-1]) != '':
-                file_name = url_parts[-1]
-            elif len(url_parts) > 1:
-                file_name = url_parts[-2]
-        except Exception:
-            file_name = 'archive file '
+                file_output.write(
+                    f'<FIELD name={xml.sax.saxutils.quoteattr(str(key))} '
+                    f'datatype="{datatype}"{arraysize}/>\n')
 
-        return file_name
+            file_output.write(
+                '<DATA><BINARY2><STREAM encoding="base64">\n')
+
+            data = bytearray()
+
+            for row in rows:
+                data += TableExporter._get_binary2_row(row, column_types)
+
+                if len(data) >= EXPORT_BUFFER_SIZE:
+                    # base64 encode whole 3 byte groups, keep the rest
+                    split = len(data) - len(data) % 3
+
+                    file_output.write(
+                        base64.encodebytes(data[:split]).decode('ascii'))
+
+                    del data[:split]
+
+            file_output.write(base64.encodebytes(data).decode('ascii'))
+
+            file_output.write(
+                '</STREAM></BINARY2></DATA>\n'
+                '</TABLE>\n</RESOURCE>\n</VOTABLE>\n')
+
+    @staticmethod
+    def _get_binary2_row(row, column_types):
+        null_flags = bytearray((len(row) + 7) // 8)
+        fields = []
+
+        for i, (value, column_type) in enumerate(zip(row, column_types)):
+            if value is None:
+                null_flags[i // 8] |= 0x80 >> (i % 8)
+
+            if column_type == 'boolean':
+                fields.append(b'?' if value is None else
+                              b'T' if value else b'F')
+            elif column_type == 'long':
+                fields.append(struct.pack('>q', value or 0))
+            elif column_type == 'double':
+                fields.append(struct.pack(
+                    '>d', float('nan') if value is None else value))
+            else:
+                # unicodeChar lengths count 2 byte characters
+                encoded = (value or '').encode('utf_16_be')
+                fields.append(struct.pack('>i', len(encoded) // 2) + encoded)
+
+        return bytes(null_flags) + b''.join(fields)
 
 
 class Utils:
@@ -1298,16 +4256,14 @@ class Utils:
         keeping the order in the order of key appearance in the resources
         """
 
-        resource_keys = []
+        resource_keys = {}
         for resource in urls_data:
-            for key in resource.keys():
-                if key not in resource_keys:
-                    resource_keys.append(key)
-        return resource_keys
+            resource_keys.update(dict.fromkeys(resource))
+        return list(resource_keys)
 
 
 class Logger:
-    _logs = []
+    _logs = contextvars.ContextVar('logs', default=[])
 
     ACTION_SUCCESS = 1
     ACTION_ERROR = 2
@@ -1319,6 +4275,7 @@ class Logger:
     ACTION_TYPE_ARCHIVE_CONNECTION = 2
     ACTION_TYPE_WRITE_URL = 3
     ACTION_TYPE_WRITE_FILE = 4
+    ACTION_TYPE_QUERY = 5
 
     def __init__(self):
         pass
@@ -1350,6 +4307,20 @@ class Logger:
                 log += "Error writing to file : " + message
 
             is_log_created = True
+        elif action == Logger.ACTION_TYPE_WRITE_FILE:
+            if outcome == Logger.ACTION_SUCCESS:
+                log += "Success writing file : " + message
+            else:
+                log += "Error writing file : " + message
+
+            is_log_created = True
+        elif action == Logger.ACTION_TYPE_QUERY:
+            if outcome == Logger.ACTION_SUCCESS:
+                log += "Success querying archive : " + message
+            else:
+                log += "Error querying archive : " + message
+
+            is_log_created = True
 
         if is_log_created:
             Logger._insert_log(Logger.ACTION_TYPE, log)
@@ -1360,9 +4331,13 @@ class Logger:
     def create_info_log(message):
         pass
 
+    @staticmethod
+    def reset():
+        Logger._logs.set([])
+
     @staticmethod
     def _insert_log(type, log):
-        Logger._logs.append(log)
+        Logger._logs.get().append(log)
 
     @staticmethod
     def create_log_file(archive_name, query):
@@ -1371,26 +4346,288 @@ class Logger:
         log_file += "Run summary for archive : " + archive_name + "\n"
         log_file += "With query : " + query + "\n"
 
-        for log in Logger._logs:
+        for log in Logger._logs.get():
             log_file += log + "\n"
 
         return log_file
 
 
-if __name__ == "__main__":
-    output = sys.argv[1]
-    output_csv = sys.argv[2]
-    output_html = sys.argv[3]
-    output_basic_html = sys.argv[4]
-    output_error = sys.argv[5]
+class ToolDaemonHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            job = json.loads(self.rfile.readline())
+
+            differences = self.server.get_environment_differences(
+                job['environment'])
+
+            if differences:
+                reply = {'status': 'rejected',
+                         'message': 'environment differs : ' +
+                                    ', '.join(differences)}
+            else:
+                ToolDaemon.run_job(job['directory'],
+                                   job['arguments'],
+                                   job['environment'])
+
+                reply = {'status': 'success'}
+
+        except Exception as e:
+            reply = {'status': 'error', 'message': repr(e)}
+
+        self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+
+class ToolDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Runs the jobs submitted by ToolClient on a local socket. Each job
+    runs in a thread of the daemon, so the jobs share the imported
+    libraries, the pooled session and the in-memory caches
+    """
+
+    daemon_threads = True
+
+    job_slots = threading.BoundedSemaphore(DAEMON_MAX_JOBS)
+
+    def __init__(self, socket_path):
+        super().__init__(socket_path, ToolDaemonHandler)
+
+        # jobs write wherever they are asked to, only the owner may submit
+        os.chmod(socket_path, 0o600)
+
+        self.environment = ToolClient.get_environment()
+
+    @staticmethod
+    def preload():
+        for module_name in DAEMON_PRELOAD:
+            importlib.import_module(module_name)
+
+    @staticmethod
+    def run_job(directory, arguments, environment):
+        with ToolDaemon.job_slots:
+            # the logs, the trace and the working directory are context
+            # variables, each handler thread starts with its own context
+            Logger.reset()
+            Tracer.reset(
+                environment.get('ASTRONOMICAL_ARCHIVES_TRACE', '') == '1')
+            FileHandler.set_working_directory(directory)
+
+            run_tool(arguments)
+
+    def get_environment_differences(self, environment):
+        """
+        Variables of the job that the daemon read with another value
+        when it started, such jobs are run by the client
+        """
+        return sorted(
+            name for name in set(environment) | set(self.environment)
+            if name not in DAEMON_JOB_ENVIRONMENT and
+            environment.get(name) != self.environment.get(name))
+
+
+class ToolClient:
+    """
+    Hands the command line of a run over to a ToolDaemon and waits for
+    the job to end
+    """
+
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def connect(socket_path):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.settimeout(DAEMON_CONNECT_TIMEOUT)
+
+        try:
+            client.connect(socket_path)
+        except OSError:
+            client.close()
+            return None
+
+        client.settimeout(None)
+
+        return client
+
+    @staticmethod
+    def get_environment():
+        return {name: value for name, value in os.environ.items()
+                if name.startswith(DAEMON_ENVIRONMENT_PREFIXES)}
+
+    @staticmethod
+    def submit(socket_path, arguments) -> bool:
+        """
+        Run the job on the daemon, returns False when no daemon could
+        run it so the caller can run it itself
+        """
+        client = ToolClient.connect(socket_path)
+
+        if client is None:
+            return False
+
+        # the daemon does not run in the job directory
+        job = {
+            'directory': os.getcwd(),
+            'arguments': [os.path.abspath(argument) if argument else argument
+                          for argument in arguments],
+            'environment': ToolClient.get_environment()
+        }
+
+        try:
+            with client, client.makefile('rb') as reply_file:
+                client.sendall(json.dumps(job).encode() + b'\n')
+
+                reply = reply_file.readline()
+        except OSError:
+            reply = b''
+
+        # the daemon stopped before the end of the job
+        if not reply:
+            return False
+
+        reply = json.loads(reply)
+
+        if reply['status'] == 'rejected':
+            return False
+
+        if reply['status'] != 'success':
+            raise RuntimeError('Job failed on the daemon : ' +
+                               reply['message'])
+
+        return True
+
+
+def run_tool(arguments):
+    output = arguments[0]
+    output_csv = arguments[1]
+    output_html = arguments[2]
+    output_basic_html = arguments[3]
+    output_error = arguments[4]
+
+    inputs = arguments[5]
 
-    inputs = sys.argv[6]
+    output_table = arguments[6] if len(arguments) > 6 else None
+    output_trace = arguments[7] if len(arguments) > 7 else None
 
     tool_runner = ToolRunner(inputs,
                              output,
                              output_csv,
                              output_html,
                              output_basic_html,
-                             output_error)
+                             output_error,
+                             output_table,
+                             output_trace)
 
     tool_runner.run()
+
+
+def run_daemon(arguments):
+    parser = argparse.ArgumentParser(
+        prog='astronomical_archives.py --daemon',
+        description='Run the jobs submitted on a local socket')
+    parser.add_argument('socket', nargs='?',
+                        default=DAEMON_SOCKET or
+                        os.path.join(CACHE_DIRECTORY, 'daemon.sock'))
+
+    arguments = parser.parse_args(arguments)
+
+    if os.path.exists(arguments.socket):
+        client = ToolClient.connect(arguments.socket)
+
+        if client is not None:
+            client.close()
+            print('A daemon is already listening on ' + arguments.socket)
+            return
+
+        os.remove(arguments.socket)
+
+    os.makedirs(os.path.dirname(os.path.abspath(arguments.socket)),
+                exist_ok=True)
+
+    ToolDaemon.preload()
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    tool_daemon = ToolDaemon(arguments.socket)
+
+    print('Listening on ' + arguments.socket)
+
+    try:
+        tool_daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        tool_daemon.server_close()
+        os.remove(arguments.socket)
+
+
+def build_target_preload(arguments):
+    parser = argparse.ArgumentParser(
+        prog='astronomical_archives.py --build-target-preload',
+        description='Resolve common target names into a preload file')
+    parser.add_argument('preload')
+    parser.add_argument('names', help='text file, one object name per line')
+
+    arguments = parser.parse_args(arguments)
+
+    with open(arguments.names, 'r') as names_file:
+        names = [name.strip() for name in names_file if name.strip()]
+
+    preloaded_targets = {}
+
+    for name, coordinates in CelestialObject.resolve_names(names).items():
+        if isinstance(coordinates, Exception):
+            print('Unable to resolve ' + name)
+        else:
+            preloaded_targets[CelestialObject.normalize_name(name)] = {
+                'ra': coordinates.ra.degree,
+                'dec': coordinates.dec.degree
+            }
+
+    with open(arguments.preload, 'w') as preload_file:
+        json.dump(preloaded_targets, preload_file, indent=1, sort_keys=True)
+
+    print(str(len(preloaded_targets)) + ' targets preloaded')
+
+
+def build_registry_snapshot(arguments):
+    parser = argparse.ArgumentParser(
+        prog='astronomical_archives.py --build-registry-snapshot',
+        description='Build the local registry snapshot index')
+    parser.add_argument('snapshot')
+    parser.add_argument('--loc', action='append', default=[],
+                        help='archives data table (.loc) to index')
+    parser.add_argument('--dump', action='append', default=[],
+                        help='registry dump (JSON) to index')
+    parser.add_argument('--live', action='store_true',
+                        help='refresh a TAP registry dump from RegTAP first')
+
+    arguments = parser.parse_args(arguments)
+
+    if arguments.live:
+        live_dump = arguments.snapshot + '.json'
+        RegistrySnapshot.dump_registry(live_dump)
+        arguments.dump.append(live_dump)
+
+    number_of_records = RegistrySnapshot(arguments.snapshot).build(
+        arguments.loc,
+        arguments.dump)
+
+    print(str(number_of_records) + ' registry records indexed')
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == '--build-registry-snapshot':
+        build_registry_snapshot(sys.argv[2:])
+        sys.exit(0)
+    elif sys.argv[1] == '--build-target-preload':
+        build_target_preload(sys.argv[2:])
+        sys.exit(0)
+    elif sys.argv[1] == '--daemon':
+        run_daemon(sys.argv[2:])
+        sys.exit(0)
+
+    if DAEMON_SOCKET and ToolClient.submit(DAEMON_SOCKET, sys.argv[1:]):
+        sys.exit(0)
+
+    run_tool(sys.argv[1:])